@@ -0,0 +1,234 @@
+#!/usr/bin/python3
+import getopt
+import json
+import os
+import platform
+import resource
+import sys
+import tempfile
+import time
+import zlib
+import datetime as dt
+from concurrent.futures import ProcessPoolExecutor
+import numpy as np
+
+ROOT_DIR = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+sys.path.insert(0, os.path.join(ROOT_DIR, 'raincell'))
+
+from curw.rainfall.wrf.extraction import spatial_utils
+import grid_mapping
+import interpolation
+import netcdf_reader
+import observations
+import pipeline
+import raincell_writer
+import thiessen
+
+NET_CDF_FILE = os.path.join(ROOT_DIR, 'input', 'results_wrf0_2018-09-09_18_00_0000_wrf_wrfout_d01_2018-09-09_18_00_00_rf')
+POINTS_DIR = os.path.join(ROOT_DIR, 'resources', 'local')
+SHP_FILE = os.path.join(ROOT_DIR, 'resources', 'shp', 'klb-wgs84', 'klb-wgs84.shp')
+RESOLUTIONS = {
+    '250m': 'kelani_basin_points_250m.txt',
+    '150m': 'klb_glecourse_points_150m.txt',
+    '30m': 'kelani_basin_points_30m.txt',
+}
+
+
+def usage():
+    usage_text = """
+Usage: ./bench_raincell.py [-r 250m,150m,30m] [-b 2] [-f 2] [-o results.json] [-h]
+
+Runs the RAINCELL generation stages offline against the bundled WRF output and grid point sets, with a local
+stand-in for MySQLAdapter serving synthetic station series. Reports wall time, peak RSS and throughput per stage and
+resolution, and saves them as JSON.
+
+-h  --help          Show usage
+-r  --resolutions   Comma separated grid resolutions. Default 250m,150m,30m
+-b  --backward      Past day count. Default 2
+-f  --forward       Future day count. Default 2
+-l  --latency       Simulated MySQL round trip in seconds. Default 0
+-o  --output        Path of the JSON results. Default bench_results.json
+"""
+    print(usage_text)
+
+
+class FakeAdapter:
+    # local stand-in for MySQLAdapter, serving reproducible 15 minute series for any station
+    def __init__(self, latency=0.0):
+        self.latency = latency
+
+    def retrieve_timeseries(self, meta, opts):
+        time.sleep(self.latency)
+        start = dt.datetime.strptime(opts['from'], '%Y-%m-%d %H:%M:%S')
+        end = dt.datetime.strptime(opts['to'], '%Y-%m-%d %H:%M:%S')
+        n = int((end - start).total_seconds() // 900) + 1
+        rng = np.random.RandomState(zlib.crc32(('%s|%s' % (meta['station'], meta['type'])).encode('utf-8')))
+        values = np.round(rng.gamma(0.3, 2.0, n), 1)
+        return [{'timeseries': [[start + dt.timedelta(minutes=15 * i), values[i]] for i in range(n)]}]
+
+    def close(self):
+        pass
+
+
+def _reset_peak_rss():
+    # resets the VmHWM of the process on linux, so that the next _peak_rss_mb is the peak of a single stage. Returns
+    # False where it cannot be reset
+    try:
+        with open('/proc/self/clear_refs', 'w') as f:
+            f.write('5')
+        return True
+    except OSError:
+        return False
+
+
+def _peak_rss_mb():
+    # VmHWM since the last _reset_peak_rss on linux. Elsewhere, ru_maxrss (in KB on linux, bytes on macOS) is the peak
+    # of the whole process so far
+    try:
+        with open('/proc/self/status') as f:
+            for line in f:
+                if line.startswith('VmHWM:'):
+                    return int(line.split()[1]) / 1024.0
+    except OSError:
+        pass
+    maxrss = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+    return maxrss / (1024.0 * 1024.0) if sys.platform == 'darwin' else maxrss / 1024.0
+
+
+class Stages:
+    def __init__(self):
+        self.results = []
+
+    def run(self, name, func, point_timesteps=None):
+        # the peak RSS of the stage where it can be reset (linux), otherwise the peak of the process up to its end
+        per_stage = _reset_peak_rss()
+        start = time.perf_counter()
+        value = func()
+        seconds = time.perf_counter() - start
+        peak_rss_mb = _peak_rss_mb()
+        self.results.append({
+            'stage': name,
+            'seconds': round(seconds, 6),
+            'peak_rss_mb': round(peak_rss_mb, 1),
+            'peak_rss_scope': 'stage' if per_stage else 'process',
+            'point_timesteps': point_timesteps,
+            'point_timesteps_per_sec': round(point_timesteps / seconds, 1) if point_timesteps and seconds > 0 else None,
+        })
+        print('%-22s %10.3fs %10.1f MB' % (name, seconds, peak_rss_mb))
+        return value
+
+
+def bench_resolution(resolution, duration_days, latency):
+    # runs in its own process, so that the peak RSS is the one of this resolution
+    points_file = os.path.join(POINTS_DIR, RESOLUTIONS[resolution])
+    stages = Stages()
+    print('--- %s' % resolution)
+
+    points = stages.run('load_points', lambda: pipeline.load_points(points_file))
+    models_points = {resolution: points}
+
+    # forecast window starting at the first time step of the bundled run
+    with netcdf_reader.WrfRfReader(NET_CDF_FILE) as rf_reader:
+        first = dt.datetime.strptime(rf_reader.times[0], '%Y-%m-%d_%H:%M:%S')
+    obs_end = first + dt.timedelta(hours=6)
+    obs_start = obs_end - dt.timedelta(days=duration_days[0])
+
+    forecast = stages.run('netcdf_read', lambda: pipeline.read_forecast(NET_CDF_FILE, models_points, obs_end,
+                                                                        duration_days[1]))
+    res_mins = forecast['res_mins']
+    area = forecast['areas'][resolution]
+    obs_steps = int(24 * 60 * duration_days[0] / res_mins) + 1
+    forecast_steps = forecast['forecast_steps']
+    n = len(points)
+
+    obs = stages.run('obs_fetch', lambda: observations.get_observed_precip(
+        pipeline.OBS_STATIONS, obs_start, obs_end, duration_days,
+        observations.AdapterPool(lambda: FakeAdapter(latency))))
+    thess_poly = stages.run('tessellation', lambda: spatial_utils.get_voronoi_polygons(
+        pipeline.OBS_STATIONS, SHP_FILE, add_total_area=False))
+    point_thess_idx = stages.run('thiessen_assign', lambda: thiessen.assign_points(points, thess_poly), n)
+    station_ids = thiessen.get_station_ids(thess_poly)
+    rf_y, rf_x = stages.run('wrf_mapping', lambda: grid_mapping.get_wrf_cell_idx(points, area['lat_bins'],
+                                                                                area['lon_bins']), n)
+
+    # the default thiessen and nearest schemes, interpolated in a single chunk as without a memory limit
+    obs_weights, forecast_weights = stages.run('interpolation_weights', lambda: (
+        interpolation.get_obs_weights('thiessen', points, point_thess_idx, station_ids, pipeline.OBS_STATIONS),
+        interpolation.get_forecast_weights('nearest', points, rf_y + area['row_offset'], rf_x + area['col_offset'],
+                                           forecast['lats'], forecast['lons'])), n)
+    rainfall = interpolation.SectionedRainfall(
+        (obs_weights, interpolation.get_observed_source(obs, station_ids, obs_steps)),
+        (forecast_weights, interpolation.get_forecast_source(forecast['diff'], forecast['forecast_start_idx'],
+                                                             forecast_steps,
+                                                             diff_offset=forecast['forecast_start_idx'] + 1)))
+    chunk_steps = interpolation.get_chunk_steps(n, max(obs_steps, forecast_steps))
+    chunks = stages.run('interpolate', lambda: list(rainfall.iter_chunks(chunk_steps)),
+                        n * (obs_steps + forecast_steps))
+
+    with tempfile.TemporaryDirectory() as tmp_dir:
+        output_file_path = os.path.join(tmp_dir, 'RAINCELL.DAT')
+
+        def _write():
+            with raincell_writer.open_raincell(output_file_path) as output_file:
+                writer = raincell_writer.RaincellWriter(output_file, points[:, 0])
+                writer.write_header(res_mins, 0, obs_start, obs_end)
+                for chunk in chunks:
+                    writer.write_steps(chunk)
+        stages.run('write', _write, n * (obs_steps + forecast_steps))
+        output_bytes = os.path.getsize(output_file_path)
+
+    return {
+        'resolution': resolution,
+        'points': n,
+        'res_mins': res_mins,
+        'obs_steps': obs_steps,
+        'forecast_steps': forecast_steps,
+        'output_bytes': output_bytes,
+        'total_seconds': round(sum(s['seconds'] for s in stages.results), 6),
+        'stages': stages.results,
+    }
+
+
+if __name__ == '__main__':
+    resolutions = list(RESOLUTIONS.keys())
+    backward = 2
+    forward = 2
+    latency = 0.0
+    output_path = 'bench_results.json'
+    try:
+        opts, args = getopt.getopt(sys.argv[1:], "hr:b:f:l:o:", [
+            "help", "resolutions=", "backward=", "forward=", "latency=", "output="
+        ])
+    except getopt.GetoptError:
+        usage()
+        sys.exit(2)
+    for opt, arg in opts:
+        if opt in ("-h", "--help"):
+            usage()
+            sys.exit()
+        elif opt in ("-r", "--resolutions"):
+            resolutions = arg.split(',')
+        elif opt in ("-b", "--backward"):
+            backward = int(arg)
+        elif opt in ("-f", "--forward"):
+            forward = int(arg)
+        elif opt in ("-l", "--latency"):
+            latency = float(arg)
+        elif opt in ("-o", "--output"):
+            output_path = arg
+
+    results = []
+    for resolution in resolutions:
+        with ProcessPoolExecutor(max_workers=1) as executor:
+            results.append(executor.submit(bench_resolution, resolution, (backward, forward), latency).result())
+
+    with open(output_path, 'w') as output_file:
+        json.dump({
+            'created': dt.datetime.now().strftime('%Y-%m-%d %H:%M:%S'),
+            'python': platform.python_version(),
+            'numpy': np.__version__,
+            'machine': platform.machine(),
+            'duration_days': [backward, forward],
+            'results': results,
+        }, output_file, indent=2)
+    print('bench_raincell|results saved to', output_path)
@@ -0,0 +1,228 @@
+#!/usr/bin/python3
+import json
+import getopt
+import os
+import sys
+import shutil
+import tempfile
+import traceback
+import datetime as dt
+from concurrent.futures import ProcessPoolExecutor
+import numpy as np
+import pandas as pd
+from curwmysqladapter import MySQLAdapter
+import observations
+import pipeline
+
+
+def usage():
+    usage_text = """
+Usage: ./batch_raincell.py -s YYYY-MM-DD -e YYYY-MM-DD [-t HH:MM:SS,...] [-T wrf0,wrf1,...] [-h]
+
+Generates the RAINCELL.DAT files of every run date of a date range and every forecast run tag, e.g. for backfills
+and ensemble runs. The runs are farmed out to a process pool.
+
+-h  --help          Show usage
+-s  --start-date    First run date in YYYY-MM-DD
+-e  --end-date      Last run date in YYYY-MM-DD (inclusive). Otherwise only the start date
+-t  --time          Comma separated run times in HH:00:00. Default 00:00:00
+-T  --tags          Comma separated tags of the simultaneous forecast runs E.g. wrf0,wrf1. Default wrf0. The tags
+                    other than wrf0 need a {tag} placeholder in the `NET_CDF_PATH` of CONFIG.json
+-f  --forward       Future day count
+-b  --backward      Past day count
+-M  --models        Comma separated FLO-2D models. Otherwise using the `FLO2D_MODEl` from CONFIG.json
+-j  --jobs          Number of worker processes. Default the CPU count
+    --report        Path of the JSON report of the runs
+"""
+    print(usage_text)
+
+
+def plan_runs(dates, run_times, tags, net_cdf_path, wrf_data_dir):
+    pipeline.check_tags(net_cdf_path, tags)
+    runs = []
+    for run_date in dates:
+        for run_time in run_times:
+            for tag in tags:
+                start_ts_lk = dt.datetime.strptime('%s %s' % (run_date, run_time), '%Y-%m-%d %H:%M:%S')
+                runs.append({
+                    'name': '%s_%s_%s' % (tag, run_date, run_time),
+                    'run_date': run_date,
+                    'run_time': run_time,
+                    'tag': tag,
+                    'start_ts_lk': start_ts_lk.strftime('%Y-%m-%d_%H:00'),
+                    'netcdf_file': pipeline.get_netcdf_file(net_cdf_path, run_date, tag),
+                    'output_dir': os.path.join(wrf_data_dir, '%s_%s_%s' % (run_date, run_time, tag)),
+                })
+    return runs
+
+
+def share_points(models_points, shared_dir):
+    # the points arrays are saved once as .npy, the workers memory-map them instead of each parsing the text files
+    points_npy = {}
+    for model, points_file in models_points.items():
+        points_npy[model] = os.path.join(shared_dir, 'points_%s.npy' % model)
+        np.save(points_npy[model], pipeline.load_points(points_file))
+    return points_npy
+
+
+def share_obs(obs, shared_dir, name):
+    obs_npy = os.path.join(shared_dir, 'obs_%s.npy' % name)
+    np.save(obs_npy, obs.values)
+    return {'values': obs_npy, 'stations': list(obs.columns), 'index': [str(t) for t in obs.index]}
+
+
+def load_obs(shared_obs):
+    return pd.DataFrame(np.load(shared_obs['values'], mmap_mode='r'), columns=shared_obs['stations'],
+                        index=pd.DatetimeIndex(shared_obs['index']))
+
+
+def run_raincell(run):
+    # worker : generates the RAINCELL.DAT files of a single run, reporting instead of raising failures
+    started = dt.datetime.now()
+    try:
+        if run.get('obs_error') is not None:
+            raise observations.CurwObservationException(run['obs_error'])
+        points = {m: np.load(f, mmap_mode='r') for m, f in run['points_npy'].items()}
+        results = pipeline.generate_raincells(run['netcdf_file'], run['start_ts_lk'], run['duration_days'],
+                                              run['obs_stations'], run['models_points'], run['shp_file'], None,
+                                              run['output_dir'], mapping_cache_dir=run['mapping_cache_dir'],
+                                              forecast_source=run['tag'], max_workers=1, points=points,
+                                              obs=load_obs(run['obs']))
+        status = {'status': 'success', 'outputs': [r[1] for r in results]}
+    except Exception as e:
+        status = {'status': 'failed', 'error': '%s: %s' % (type(e).__name__, e), 'traceback': traceback.format_exc()}
+    status.update({'run': run['name'], 'seconds': (dt.datetime.now() - started).total_seconds()})
+    return status
+
+
+def run_batch(runs, duration_days, obs_stations, models_points, shp_file, adapter, mapping_cache_dir, jobs=None):
+    shared_dir = tempfile.mkdtemp(prefix='raincell_batch_')
+    try:
+        points_npy = share_points(models_points, shared_dir)
+
+        # one observation fetch per unique observed window and fallback forecast source
+        shared_obs = {}
+        for run in runs:
+            obs_key = (run['start_ts_lk'], run['tag'])
+            if obs_key not in shared_obs:
+                obs_end = dt.datetime.strptime(run['start_ts_lk'], '%Y-%m-%d_%H:%M')
+                obs_start = obs_end - dt.timedelta(days=duration_days[0])
+                try:
+                    obs = observations.get_observed_precip(obs_stations, obs_start, obs_end, duration_days, adapter,
+                                                           forecast_source=run['tag'])
+                    shared_obs[obs_key] = share_obs(obs, shared_dir, '%s_%s' % (run['tag'], len(shared_obs)))
+                except Exception as e:
+                    shared_obs[obs_key] = '%s: %s' % (type(e).__name__, e)
+            if isinstance(shared_obs[obs_key], str):
+                run['obs'], run['obs_error'] = None, shared_obs[obs_key]
+            else:
+                run['obs'], run['obs_error'] = shared_obs[obs_key], None
+            run.update({
+                'duration_days': duration_days,
+                'obs_stations': obs_stations,
+                'models_points': models_points,
+                'points_npy': points_npy,
+                'shp_file': shp_file,
+                'mapping_cache_dir': mapping_cache_dir,
+            })
+
+        # the first run builds the mappings, so that the workers only load them from the cache
+        report = [run_raincell(runs[0])] if len(runs) > 0 else []
+        with ProcessPoolExecutor(max_workers=jobs) as executor:
+            report += list(executor.map(run_raincell, runs[1:]))
+    finally:
+        shutil.rmtree(shared_dir, ignore_errors=True)
+    return report
+
+
+if __name__ == '__main__':
+    start_date = None
+    end_date = None
+    run_times = ['00:00:00']
+    tags = ['wrf0']
+    backward = 2
+    forward = 3
+    models = None
+    jobs = None
+    report_path = None
+    try:
+        opts, args = getopt.getopt(sys.argv[1:], "hs:e:t:T:f:b:M:j:", [
+            "help", "start-date=", "end-date=", "time=", "tags=", "forward=", "backward=", "models=", "jobs=",
+            "report="
+        ])
+    except getopt.GetoptError:
+        usage()
+        sys.exit(2)
+    for opt, arg in opts:
+        if opt in ("-h", "--help"):
+            usage()
+            sys.exit()
+        elif opt in ("-s", "--start-date"):
+            start_date = arg
+        elif opt in ("-e", "--end-date"):
+            end_date = arg
+        elif opt in ("-t", "--time"):
+            run_times = arg.split(',')
+        elif opt in ("-T", "--tags"):
+            tags = arg.split(',')
+        elif opt in ("-f", "--forward"):
+            forward = arg
+        elif opt in ("-b", "--backward"):
+            backward = arg
+        elif opt in ("-M", "--models"):
+            models = arg.split(',')
+        elif opt in ("-j", "--jobs"):
+            jobs = int(arg)
+        elif opt == "--report":
+            report_path = arg
+    if start_date is None:
+        usage()
+        sys.exit(2)
+    duration_days = (int(backward), int(forward))
+
+    dates = [d.strftime('%Y-%m-%d') for d in pd.date_range(start_date, end_date or start_date, freq='D')]
+
+    obs_stations = pipeline.OBS_STATIONS
+    with open('CONFIG.json') as json_file:
+        config_data = json.load(json_file)
+    MYSQL_HOST = config_data['MYSQL_HOST']
+    MYSQL_USER = config_data['MYSQL_USER']
+    MYSQL_DB = config_data['MYSQL_DB']
+    MYSQL_PASSWORD = config_data['MYSQL_PASSWORD']
+    WRF_DATA_DIR = config_data['WRF_DATA_DIR']
+    NET_CDF_PATH = config_data['NET_CDF_PATH']
+    # the workers share the mappings through the cache, so the batch always uses one
+    mapping_cache_dir = config_data.get('MAPPING_CACHE_DIR', os.path.join(WRF_DATA_DIR, 'mapping_cache'))
+    if models is None:
+        models = config_data['FLO2D_MODEl'].split(',')
+    models_points = {m: os.path.join(WRF_DATA_DIR, pipeline.MODEL_POINTS.get(m, pipeline.MODEL_POINTS['250m']))
+                     for m in models}
+    kelani_lower_basin_shp = os.path.join(WRF_DATA_DIR, 'klb-wgs84/klb-wgs84.shp')
+
+    runs = []
+    report = []
+    for run in plan_runs(dates, run_times, tags, NET_CDF_PATH, WRF_DATA_DIR):
+        if os.path.exists(run['output_dir']):
+            report.append({'run': run['name'], 'status': 'skipped', 'error': '%s already exists' % run['output_dir']})
+        elif not os.path.exists(run['netcdf_file']):
+            report.append({'run': run['name'], 'status': 'failed', 'error': '%s not found' % run['netcdf_file']})
+        else:
+            runs.append(run)
+    print('batch_raincell|%d runs planned, %d skipped' % (len(runs), len(report)))
+
+    adapter = observations.AdapterPool(
+        lambda: MySQLAdapter(host=MYSQL_HOST, user=MYSQL_USER, password=MYSQL_PASSWORD, db=MYSQL_DB),
+        size=int(config_data.get('MYSQL_POOL_SIZE', 4)))
+    try:
+        report += run_batch(runs, duration_days, obs_stations, models_points, kelani_lower_basin_shp, adapter,
+                            mapping_cache_dir, jobs=jobs)
+    finally:
+        adapter.close()
+
+    for r in report:
+        print('%-40s %-8s %s' % (r['run'], r['status'], r.get('error', '')))
+    if report_path is not None:
+        with open(report_path, 'w') as report_file:
+            json.dump(report, report_file, indent=2)
+    if any(r['status'] == 'failed' for r in report):
+        sys.exit(1)
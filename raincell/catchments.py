@@ -0,0 +1,183 @@
+import os
+import geopandas as gpd
+import numpy as np
+import pandas as pd
+from scipy import sparse
+from shapely.geometry import box
+import grid_mapping
+import interpolation
+import netcdf_reader
+import thiessen
+
+# Mean rainfall series of whole catchments (e.g. the sub-catchments of the Colombo metro area), as a sparse
+# (catchment, source) weight matrix built once per run. The catchments are polygons of a shape file, for which the
+# weights are the shares of their area in each WRF cell or thiessen polygon, or points (centroids, stations) which
+# take the rainfall of their WRF cell or thiessen polygon.
+
+# projection in which the areas of the catchment parts are measured
+EQUAL_AREA_CRS = 'EPSG:6933'
+# attributes tried in turn for the id of the catchment polygons of a shape file
+ID_ATTRS = ('Name', 'name', 'Raingauge', 'id')
+# covered fraction under which get_catchment_rf reports a catchment as partly covered, and under which its mean
+# rainfall (over the covered part) is NaN, as too little of the catchment is known
+FULL_COVERAGE = 0.999
+MIN_COVERAGE = 0.5
+
+
+def _load_points_file(path, netcdf_file=None):
+    # 'name,lon,lat' with a header line, e.g. metro_col_sub_catch_centroids.txt, or 'name col row' WRF grid cells
+    # e.g. kelani_basin_stations.txt, which are placed at the cell centres of the grid of netcdf_file
+    with open(path) as f:
+        first = f.readline()
+    if ',' in first:
+        df = pd.read_csv(path)
+        return [str(s) for s in df.iloc[:, 0]], gpd.points_from_xy(df.iloc[:, 1], df.iloc[:, 2])
+
+    df = pd.read_csv(path, sep=r'\s+', header=None, names=['name', 'col', 'row'])
+    if netcdf_file is None:
+        raise ValueError('%s holds WRF grid cells, the WRF rf file is needed to place them' % path)
+    with netcdf_reader.WrfRfReader(netcdf_file) as rf_reader:
+        lats, lons = rf_reader.get_axes(slice(None), slice(None))
+    return [str(s) for s in df['name']], gpd.points_from_xy(np.asarray(lons)[df['col']], np.asarray(lats)[df['row']])
+
+
+def load_catchments(paths, netcdf_file=None, id_attr=None):
+    # GeoDataFrame of the 'id' and geometry of the catchments of the shape files and points files of paths. With
+    # several files, the ids are prefixed by the name of their file
+    frames = []
+    for path in paths:
+        stem = os.path.splitext(os.path.basename(path))[0]
+        if path.endswith('.shp'):
+            df = gpd.read_file(path).to_crs('EPSG:4326')
+            attr = id_attr or next((a for a in ID_ATTRS if a in df.columns), None)
+            ids = [str(s) for s in df[attr]] if attr is not None else \
+                [stem] if len(df) == 1 else ['%s_%d' % (stem, i) for i in range(len(df))]
+            geometry = df.geometry.values
+        else:
+            ids, geometry = _load_points_file(path, netcdf_file)
+        if len(paths) > 1:
+            ids = ['%s.%s' % (stem, s) for s in ids]
+        frames.append(gpd.GeoDataFrame({'id': ids}, geometry=geometry, crs='EPSG:4326'))
+    return gpd.GeoDataFrame(pd.concat(frames, ignore_index=True), crs='EPSG:4326')
+
+
+def get_extent_points(catchments):
+    # [id, lon, lat] rows of the corners of the bounds of the catchments, for pipeline.read_forecast
+    bounds = catchments.bounds.values
+    corners = np.concatenate([bounds[:, [0, 1]], bounds[:, [2, 3]]])
+    return np.column_stack([np.arange(len(corners)), corners])
+
+
+def get_cell_polygons(lats, lons):
+    # boxes of the WRF cells of the lats x lons window, in the (row, col) raveled order of the cells
+    def _edges(axis):
+        mid = (axis[1:] + axis[:-1]) / 2
+        return np.concatenate([[axis[0] - (axis[1] - axis[0]) / 2], mid, [axis[-1] + (axis[-1] - axis[-2]) / 2]])
+
+    lat_edges, lon_edges = _edges(np.asarray(lats, dtype=float)), _edges(np.asarray(lons, dtype=float))
+    return gpd.GeoDataFrame({'cell': np.arange(len(lats) * len(lons))},
+                            geometry=[box(lon_edges[c], lat_edges[r], lon_edges[c + 1], lat_edges[r + 1])
+                                      for r in range(len(lats)) for c in range(len(lons))], crs='EPSG:4326')
+
+
+def _area_weights(catchments, polygons, polygon_idx):
+    # (catchment, polygon) shares of the covered area of each catchment polygon within each of the polygons, and the
+    # covered fraction of each catchment polygon (0 for the point catchments). The mean is over the covered part
+    # only, see MIN_COVERAGE
+    is_polygon = catchments.geom_type.isin(['Polygon', 'MultiPolygon']).values
+    parts = gpd.overlay(gpd.GeoDataFrame({'catchment': np.flatnonzero(is_polygon)},
+                                         geometry=catchments.geometry.values[is_polygon], crs=catchments.crs),
+                        gpd.GeoDataFrame({'polygon': polygon_idx}, geometry=polygons.geometry.values,
+                                         crs=catchments.crs),
+                        how='intersection', keep_geom_type=True)
+    area = parts.geometry.to_crs(EQUAL_AREA_CRS).area.values
+    catchment_area = np.where(is_polygon, catchments.geometry.to_crs(EQUAL_AREA_CRS).area.values, 0)
+    covered = np.bincount(parts['catchment'].values, weights=area, minlength=len(catchments))
+    coverage = np.zeros(len(catchments))
+    np.divide(covered, catchment_area, out=coverage, where=catchment_area > 0)
+    return sparse.csr_matrix((area / covered[parts['catchment'].values],
+                              (parts['catchment'].values, parts['polygon'].values)),
+                             shape=(len(catchments), len(polygons))), np.minimum(coverage, 1), is_polygon
+
+
+def _point_array(catchments, is_polygon):
+    # [id, lon, lat] rows of the point catchments, see pipeline.load_points
+    idx = np.flatnonzero(~is_polygon)
+    geometry = catchments.geometry.values[idx]
+    return idx, np.column_stack([idx, gpd.GeoSeries(geometry).x.values, gpd.GeoSeries(geometry).y.values])
+
+
+def get_forecast_weights(catchments, lats, lons):
+    # (catchment, WRF cell) weights over the lats x lons window, and the covered fraction of each catchment
+    weights, coverage, is_polygon = _area_weights(catchments, get_cell_polygons(lats, lons),
+                                                  np.arange(len(lats) * len(lons)))
+    idx, points = _point_array(catchments, is_polygon)
+    if len(idx) > 0:
+        rows, cols = grid_mapping.get_wrf_cell_idx(points, grid_mapping.get_bins(np.asarray(lats)),
+                                                   grid_mapping.get_bins(np.asarray(lons)))
+        weights = weights + sparse.csr_matrix((np.ones(len(idx)), (idx, rows * len(lons) + cols)),
+                                              shape=weights.shape)
+        coverage[idx] = 1
+    return weights.tocsr(), coverage
+
+
+def get_obs_weights(catchments, thess_poly):
+    # (catchment, station) weights, in the order of thiessen.get_station_ids(thess_poly), and the covered fraction
+    # of each catchment
+    weights, coverage, is_polygon = _area_weights(catchments, thess_poly, np.arange(len(thess_poly)))
+    idx, points = _point_array(catchments, is_polygon)
+    if len(idx) > 0:
+        station_idx = thiessen.assign_points(points, thess_poly)
+        inside = station_idx != thiessen.OUTSIDE
+        weights = weights + sparse.csr_matrix((np.ones(inside.sum()), (idx[inside], station_idx[inside])),
+                                              shape=weights.shape)
+        coverage[idx] = inside
+    return weights.tocsr(), coverage
+
+
+def _interpolate_covered(weights, coverage, source, min_coverage):
+    # (time, catchment) mean rainfall, NaN for the catchments covered less than min_coverage by the source polygons
+    rf = interpolation.interpolate(weights, source)
+    rf[:, coverage < min_coverage] = np.nan
+    return rf
+
+
+def get_catchment_rf(catchments, forecast, obs, thess_poly, obs_start, obs_steps, min_coverage=MIN_COVERAGE):
+    # ((time, catchment) DataFrame of the mean rainfall of the catchments over the observed and forecast window of
+    # a RAINCELL.DAT, (catchment, 'observed' / 'forecast') DataFrame of the covered fraction of each catchment), see
+    # pipeline.read_forecast and observations.get_observed_precip
+    station_ids = thiessen.get_station_ids(thess_poly)
+    station_rf = interpolation.get_observed_source(obs, station_ids, obs_steps)
+    forecast_source = interpolation.get_forecast_source(forecast['diff'], forecast['forecast_start_idx'],
+                                                        forecast['forecast_steps'],
+                                                        diff_offset=forecast['forecast_start_idx'] + 1)
+    obs_weights, obs_coverage = get_obs_weights(catchments, thess_poly)
+    forecast_weights, forecast_coverage = get_forecast_weights(catchments, forecast['lats'], forecast['lons'])
+    for name, coverage in (('thiessen polygons', obs_coverage), ('WRF cells', forecast_coverage)):
+        for catchment_id, fraction in zip(catchments['id'], coverage):
+            if fraction < FULL_COVERAGE:
+                print('get_catchment_rf|%s : %.1f%% of its area within the %s' % (catchment_id, 100 * fraction, name))
+    rf = np.concatenate([_interpolate_covered(obs_weights, obs_coverage, station_rf, min_coverage),
+                         _interpolate_covered(forecast_weights, forecast_coverage, forecast_source, min_coverage)])
+    index = pd.date_range(obs_start, periods=len(rf), freq='%dmin' % forecast['res_mins'], name='Time')
+    coverage = pd.DataFrame({'observed': obs_coverage, 'forecast': forecast_coverage},
+                            index=pd.Index(list(catchments['id']), name='id'))
+    return pd.DataFrame(rf, index=index, columns=list(catchments['id'])), coverage
+
+
+def get_coverage_path(path):
+    # the coverage of the catchments is written next to their series, e.g. CATCHMENT_RAIN_COVERAGE.csv
+    stem, ext = os.path.splitext(path)
+    return '%s_COVERAGE%s' % (stem, ext)
+
+
+def write_catchment_rf(catchment_rf, path, coverage=None):
+    # a single CSV, or Parquet for a .parquet path, and the coverage (see get_catchment_rf) next to it
+    if path.endswith('.parquet'):
+        catchment_rf.to_parquet(path)
+        if coverage is not None:
+            coverage.to_parquet(get_coverage_path(path))
+    else:
+        catchment_rf.to_csv(path, float_format='%.3f')
+        if coverage is not None:
+            coverage.to_csv(get_coverage_path(path), float_format='%.4f')
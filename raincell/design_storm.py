@@ -0,0 +1,308 @@
+#!/usr/bin/python3
+import hashlib
+import json
+import getopt
+import os
+import sys
+import datetime as dt
+import numpy as np
+import pandas as pd
+from curw.rainfall.wrf.extraction import spatial_utils
+import interpolation
+import mapping_cache
+import metrics
+import observations
+import pipeline
+import raincell_writer
+import staging
+
+# RAINCELL.DAT of design and historical storms, replayed from the station series of a columnar store. The store is
+# converted once from the station CSVs (see convert_csvs), and a single run generates any number of scenarios : a
+# window, a resolution, a station set and a scale of the rainfall. The voronoi polygons and the point mappings are
+# built once per station set and model, and shared by all the scenarios using them.
+
+# the gauges of the 2016-05 storm, {station: [lon, lat]}
+DEFAULT_STATIONS = {
+    'Colombo': [79.87203, 6.905],
+    'Glencourse': [80.19435, 6.977385],
+    'Hanwella': [80.08402, 6.91022],
+}
+
+
+def usage():
+    usage_text = """
+Usage: ./design_storm.py -s scenarios.json -i store.npz [-M 250m,150m] [-o output_dir] [-h]
+       ./design_storm.py --convert Colombo.csv,Hanwella.csv -i store.npz
+
+Generates the RAINCELL.DAT of every scenario of a scenarios file, from the station series of a columnar store.
+
+-h  --help          Show usage
+-s  --scenarios     JSON file of {"stations": {station: [lon, lat]}, "scenarios": [{"name", "start", "end",
+                    "res_mins", "stations", "scale"}]}. start and end in YYYY-MM-DD HH:MM:SS, res_mins (default 10),
+                    stations (default all) and scale (default 1) are optional. Without stations, the gauges of the
+                    2016-05 storm are used
+-i  --input         Store of the station series (.npz, or .parquet)
+    --convert       Comma separated station CSVs (a `Time` column and the rainfall) to convert into the store, named
+                    after their files
+-M  --models        Comma separated FLO-2D models. Otherwise using the `FLO2D_MODEl` from CONFIG.json
+-o  --output        Output directory, with a directory per scenario. Otherwise WRF_DATA_DIR/design_storms
+    --compress      Also write a compressed copy of each RAINCELL.DAT (gzip or zstd)
+    --metrics       Path of the metrics file, where the per stage timings and counters of the run are appended as a
+                    JSON line. Otherwise using the `METRICS_FILE` from CONFIG.json, if any
+"""
+    print(usage_text)
+
+
+def read_station_csv(path):
+    # readings of a station CSV, e.g. Colombo.csv of the 2016-05 storm
+    return observations.frame_to_series(pd.read_csv(path, index_col='Time'))
+
+
+def convert_csvs(csv_paths, store_path):
+    # station series of the CSVs, named by their file, in a single store : a .parquet table of (station, Time, value)
+    # rows, otherwise an .npz of the concatenated times (ns) and values with the offsets of each station
+    stations = [os.path.splitext(os.path.basename(p))[0] for p in csv_paths]
+    series = [read_station_csv(p).sort_index() for p in csv_paths]
+    if store_path.endswith('.parquet'):
+        pd.concat([pd.DataFrame({'station': s, 'Time': ts.index, 'value': ts.values})
+                   for s, ts in zip(stations, series)], ignore_index=True).to_parquet(store_path)
+        return stations
+    offsets = np.concatenate([[0], np.cumsum([len(ts) for ts in series])])
+    with staging.atomic_write(store_path, 'wb') as f:
+        np.savez(f, stations=np.array(stations, dtype=str), offsets=offsets,
+                 times=np.concatenate([ts.index.values.astype('datetime64[ns]').astype(np.int64) for ts in series]),
+                 values=np.concatenate([ts.values.astype(float) for ts in series]))
+    return stations
+
+
+def load_store(store_path):
+    # {station: series} of a store of convert_csvs
+    if store_path.endswith('.parquet'):
+        df = pd.read_parquet(store_path)
+        return {str(s): pd.Series(g['value'].values, index=pd.DatetimeIndex(g['Time'].values))
+                for s, g in df.groupby('station', sort=False)}
+    with np.load(store_path, allow_pickle=False) as data:
+        offsets, times, values = data['offsets'], data['times'], data['values']
+        return {str(s): pd.Series(values[offsets[i]:offsets[i + 1]],
+                                  index=pd.DatetimeIndex(times[offsets[i]:offsets[i + 1]].astype('datetime64[ns]')))
+                for i, s in enumerate(data['stations'])}
+
+
+def get_store(csv_paths, store_dir):
+    # {station: series} of the CSVs, through a store of store_dir keyed by their names and contents, so that a
+    # different set of files or an edited file is converted again
+    sha1 = hashlib.sha1()
+    for path in sorted(csv_paths):
+        sha1.update(('%s|%s|' % (os.path.basename(path), mapping_cache.file_digest(path))).encode('utf-8'))
+    store_path = os.path.join(store_dir, 'stations_%s.npz' % sha1.hexdigest())
+    run_metrics = metrics.get_metrics()
+    if not os.path.exists(store_path):
+        if not os.path.exists(store_dir):
+            os.makedirs(store_dir, exist_ok=True)
+        with run_metrics.timer('store_convert'):
+            convert_csvs(csv_paths, store_path)
+    with run_metrics.timer('store_load'):
+        return load_store(store_path)
+
+
+def load_scenarios(path):
+    # ({station: [lon, lat]}, [scenario]) of a scenarios file, see usage
+    with open(path) as f:
+        config = json.load(f)
+    stations = config.get('stations') or DEFAULT_STATIONS
+    scenarios = []
+    for i, scenario in enumerate(config['scenarios']):
+        scenario = dict({'name': 'scenario_%d' % i, 'res_mins': 10, 'stations': sorted(stations), 'scale': 1.0},
+                        **scenario)
+        unknown = [s for s in scenario['stations'] if s not in stations]
+        if unknown:
+            raise ValueError('%s : unknown stations %s' % (scenario['name'], unknown))
+        scenarios.append(scenario)
+    return stations, scenarios
+
+
+class DesignStormEngine:
+    # stations : {station: [lon, lat]}, series : {station: series} (see load_store)
+    def __init__(self, stations, series, models_points, shp_file, mapping_cache_dir=None, memory_limit_mb=None):
+        self.stations = stations
+        self.series = series
+        self.models_points = models_points
+        self.shp_file = shp_file
+        self.mapping_cache_dir = mapping_cache_dir
+        self.memory_limit_mb = memory_limit_mb
+        self.points = {m: pipeline.load_points(f) for m, f in models_points.items()}
+        # shared by the scenarios, per station set, and per station set and model
+        self._thess_poly = {}
+        self._weights = {}
+
+    def get_thess_poly(self, station_set):
+        if station_set not in self._thess_poly:
+            obs_stations = {s: self.stations[s] for s in station_set}
+            with metrics.get_metrics().timer('voronoi'):
+                self._thess_poly[station_set] = mapping_cache.get_voronoi_polygons(
+                    self.mapping_cache_dir, obs_stations, self.shp_file,
+                    lambda: spatial_utils.get_voronoi_polygons(obs_stations, self.shp_file, add_total_area=False))
+        return self._thess_poly[station_set]
+
+    def get_weights(self, model, station_set):
+        # ((point, station) thiessen weights, station ids) of the points of model
+        key = (model, station_set)
+        if key not in self._weights:
+            with metrics.get_metrics().timer('thiessen_mapping'):
+                point_idx, station_ids = mapping_cache.get_thiessen_mapping(
+                    self.mapping_cache_dir, self.models_points[model], self.points[model],
+                    {s: self.stations[s] for s in station_set}, self.shp_file,
+                    lambda: self.get_thess_poly(station_set))
+            self._weights[key] = (interpolation.thiessen_weights(point_idx, len(station_ids)), station_ids)
+        return self._weights[key]
+
+    def get_source(self, scenario, station_ids, used, start, n_steps):
+        # (time, station) rainfall of the scenario window, for the stations of the used columns only (others stay 0)
+        source = np.zeros((n_steps, len(station_ids)))
+        for j in used:
+            s = station_ids[j]
+            if s not in self.series:
+                raise observations.CurwObservationException('%s : no series for %s' % (scenario['name'], s))
+            ts = observations.aggregate_ts(self.series[s], start, n_steps, freq='%dmin' % scenario['res_mins'])
+            if not observations.is_complete(ts):
+                raise observations.CurwObservationException('%s time series validation failed' % s)
+            source[:, j] = ts.values
+        return source * scenario['scale']
+
+    def generate(self, scenario, output_dir, staging_dir=None, compression=None):
+        # writes the RAINCELL.DAT of every model for a scenario into output_dir, returning their manifest entries
+        start = dt.datetime.strptime(scenario['start'], '%Y-%m-%d %H:%M:%S')
+        end = dt.datetime.strptime(scenario['end'], '%Y-%m-%d %H:%M:%S')
+        res_mins = scenario['res_mins']
+        data_hours = int((end - start).total_seconds() / 60 / res_mins)
+        n_steps = data_hours + 1
+        station_set = tuple(sorted(scenario['stations']))
+        run_metrics = metrics.get_metrics()
+
+        entries = []
+        for model in self.models_points:
+            weights, station_ids = self.get_weights(model, station_set)
+            used = np.flatnonzero(weights.getnnz(axis=0))
+            with run_metrics.timer('design_source'):
+                source = self.get_source(scenario, station_ids, used, start, n_steps)
+            rainfall = interpolation.SectionedRainfall((weights, source))
+            chunk_steps = interpolation.get_chunk_steps(len(self.points[model]), n_steps, self.memory_limit_mb)
+
+            output_file_path = pipeline.get_output_path(output_dir, model, len(self.models_points))
+            if not os.path.exists(os.path.dirname(output_file_path)):
+                os.makedirs(os.path.dirname(output_file_path))
+            staging_path = staging.get_staging_path(output_file_path, staging_dir)
+            try:
+                with run_metrics.timer('write'), raincell_writer.open_raincell(staging_path) as output_file:
+                    writer = raincell_writer.RaincellWriter(output_file, self.points[model][:, 0],
+                                                            chunk_steps=min(chunk_steps, 24))
+                    writer.write_header(res_mins, data_hours, start, end)
+                    for rf in rainfall.iter_chunks(chunk_steps):
+                        writer.write_steps(rf)
+                with run_metrics.timer('publish'):
+                    entry = staging.publish(staging_path, output_file_path, compression=compression)
+            finally:
+                if os.path.exists(staging_path):
+                    os.remove(staging_path)
+            entry['model'] = model
+            entries.append(entry)
+            run_metrics.count('points', len(self.points[model]))
+            run_metrics.count('lines_written', writer.lines_written)
+            run_metrics.count('bytes_written', os.path.getsize(output_file_path))
+            print('design_storm|%s %s : %s (%d lines)' % (scenario['name'], model, output_file_path,
+                                                          writer.lines_written))
+        staging.write_manifest(output_dir, entries, scenario=scenario)
+        run_metrics.count('scenarios')
+        return entries
+
+
+def generate_design_storms(stations, scenarios, series, models_points, shp_file, output_dir, mapping_cache_dir=None,
+                           memory_limit_mb=None, staging_dir=None, compression=None):
+    # the RAINCELL.DAT files of every scenario into output_dir/<scenario name>. A failed scenario is reported, and
+    # does not stop the others. Returns {scenario name: error or None}
+    staging.check_compression(compression)
+    engine = DesignStormEngine(stations, series, models_points, shp_file, mapping_cache_dir=mapping_cache_dir,
+                               memory_limit_mb=memory_limit_mb)
+    report = {}
+    for scenario in scenarios:
+        try:
+            engine.generate(scenario, os.path.join(output_dir, scenario['name']), staging_dir=staging_dir,
+                            compression=compression)
+            report[scenario['name']] = None
+        except Exception as e:
+            report[scenario['name']] = '%s: %s' % (type(e).__name__, e)
+            print('design_storm|%s failed : %s' % (scenario['name'], report[scenario['name']]))
+    return report
+
+
+if __name__ == '__main__':
+    scenarios_path = None
+    store_path = None
+    convert = None
+    models = None
+    output_dir = None
+    compression = None
+    metrics_file = None
+    try:
+        opts, args = getopt.getopt(sys.argv[1:], "hs:i:M:o:", [
+            "help", "scenarios=", "input=", "convert=", "models=", "output=", "compress=", "metrics="
+        ])
+    except getopt.GetoptError:
+        usage()
+        sys.exit(2)
+    for opt, arg in opts:
+        if opt in ("-h", "--help"):
+            usage()
+            sys.exit()
+        elif opt in ("-s", "--scenarios"):
+            scenarios_path = arg
+        elif opt in ("-i", "--input"):
+            store_path = arg
+        elif opt == "--convert":
+            convert = arg.split(',')
+        elif opt in ("-M", "--models"):
+            models = arg.split(',')
+        elif opt in ("-o", "--output"):
+            output_dir = arg
+        elif opt == "--compress":
+            compression = arg
+        elif opt == "--metrics":
+            metrics_file = arg
+    if store_path is None or (convert is None and scenarios_path is None):
+        usage()
+        sys.exit(2)
+    if convert is not None:
+        print('design_storm|converted %s into %s' % (convert_csvs(convert, store_path), store_path))
+        sys.exit()
+
+    with open('CONFIG.json') as json_file:
+        config_data = json.load(json_file)
+    WRF_DATA_DIR = config_data['WRF_DATA_DIR']
+    mapping_cache_dir = config_data.get('MAPPING_CACHE_DIR')
+    if metrics_file is None:
+        metrics_file = config_data.get('METRICS_FILE')
+    if metrics_file is not None:
+        metrics.set_metrics(metrics.Metrics())
+    if models is None:
+        models = config_data['FLO2D_MODEl'].split(',')
+    models_points = {m: os.path.join(WRF_DATA_DIR, pipeline.MODEL_POINTS.get(m, pipeline.MODEL_POINTS['250m']))
+                     for m in models}
+    kelani_lower_basin_shp = os.path.join(WRF_DATA_DIR, 'klb-wgs84/klb-wgs84.shp')
+
+    stations, scenarios = load_scenarios(scenarios_path)
+    with metrics.get_metrics().timer('total'):
+        with metrics.get_metrics().timer('store_load'):
+            series = load_store(store_path)
+        report = generate_design_storms(stations, scenarios, series, models_points, kelani_lower_basin_shp,
+                                        output_dir or os.path.join(WRF_DATA_DIR, 'design_storms'),
+                                        mapping_cache_dir=mapping_cache_dir,
+                                        memory_limit_mb=int(config_data['MEMORY_LIMIT_MB'])
+                                        if config_data.get('MEMORY_LIMIT_MB') is not None else None,
+                                        staging_dir=config_data.get('STAGING_DIR'), compression=compression)
+    failed = [name for name, error in report.items() if error is not None]
+    if metrics_file is not None:
+        metrics.get_metrics().print_summary()
+        metrics.get_metrics().dump(metrics_file, scenarios=list(report.keys()), failed=failed,
+                                   models=list(models_points.keys()))
+    print('design_storm|%d scenarios, %d failed' % (len(report), len(failed)))
+    sys.exit(1 if failed else 0)
@@ -1,23 +1,18 @@
 from curw.rainfall.wrf.resources import manager as res_mgr
 from curw.rainfall.wrf.extraction import observation_utils as wrf_utils
 import json
-import numpy as np
 import os
-import pandas as pd
-from curw.rainfall.wrf.extraction import utils as ext_utils
-from curw.rainfall.wrf.extraction import spatial_utils
-from curw.rainfall.wrf import utils
 import datetime as dt
 from curwmysqladapter import MySQLAdapter
-from numpy import genfromtxt
+import design_storm
+import metrics
 
 WRF_DATA_DIR = '/home/hasitha/PycharmProjects/WrfSupport/resources/local'
 WRF_OUTPUT_DIR = '/home/hasitha/PycharmProjects/WrfSupport/output'
 WRF_SHAPE_DIR = '/home/hasitha/PycharmProjects/WrfSupport/resources/shp'
-
-
-class CurwObservationException(Exception):
-    pass
+MAPPING_CACHE_DIR = '/home/hasitha/PycharmProjects/WrfSupport/cache'
+WRF_INPUT_DIR = '/home/hasitha/PycharmProjects/WrfSupport/input'
+DESIGN_STORM_STORE_DIR = os.path.join(WRF_INPUT_DIR, 'design_storm')
 
 
 def get_curw_adapter(mysql_config=None, mysql_config_path=None):
@@ -70,127 +65,30 @@ def download_raincell_file(model, adapter, net_cdf_file_name, start_ts_lk, durat
         print("Mysql connection closed.")
 
 
-def get_observed_precip(obs_stations, start_dt, end_dt, duration_days, adapter, forecast_source='wrf0', ):
-    def _validate_ts(_s, _ts_sum, _opts):
-        print('len(_ts_sum):',len(_ts_sum))
-        print('duration_days[0] * 24 + 1:',duration_days[0] * 24 + 1)
-        if len(_ts_sum) == duration_days[0] * 24 + 1:
-            return
-
-        f_station = {'station': obs_stations[_s][3],
-                     'variable': 'Precipitation',
-                     'unit': 'mm',
-                     'type': 'Forecast-0-d',
-                     'source': forecast_source,
-                     }
-        f_ts = np.array(adapter.retrieve_timeseries(f_station, _opts)[0]['timeseries'])
-
-        if len(f_ts) != duration_days[0] * 24 + 1:
-            raise CurwObservationException('%s Forecast time-series validation failed' % _s)
-
-        for j in range(duration_days[0] * 24 + 1):
-            d = start_dt + dt.timedelta(hours=j)
-            d_str = d.strftime('%Y-%m-%d %H:00')
-            if j < len(_ts_sum.index.values):
-                if _ts_sum.index[j] != d_str:
-                    _ts_sum.loc[d_str] = f_ts[j, 1]
-                    _ts_sum.sort_index(inplace=True)
-            else:
-                _ts_sum.loc[d_str] = f_ts[j, 1]
-
-        if len(_ts_sum) == duration_days[0] * 24 + 1:
-            return
-        else:
-            raise CurwObservationException('time series validation failed')
-
-    obs = {}
-    opts = {
-        'from': start_dt.strftime('%Y-%m-%d %H:%M:%S'),
-        'to': end_dt.strftime('%Y-%m-%d %H:%M:%S'),
-    }
-
-    for s in obs_stations.keys():
-        print('obs_stations[s][2]: ',obs_stations[s][2])
-        station = {'station': s,
-                   'variable': 'Precipitation',
-                   'unit': 'mm',
-                   'type': 'Observed',
-                   'source': 'WeatherStation',
-                   'name': obs_stations[s][2]
-                   }
-        print('station : ', s)
-        row_ts = adapter.retrieve_timeseries(station, opts)
-        if len(row_ts) == 0:
-            print('No data for {} station from {} to {} .'.format(s, start_dt.strftime('%Y-%m-%d %H:%M:%S'), end_dt.strftime('%Y-%m-%d %H:%M:%S')))
-        else:
-            ts = np.array(row_ts[0]['timeseries'])
-            #print('--------------ts : ',ts)
-            print('ts length:', len(ts))
-            if len(ts) != 0 :
-                ts_df = pd.DataFrame(data=ts, columns=['ts', 'precip'], index=ts[0:])
-                ts_sum = ts_df.groupby(by=[ts_df.ts.map(lambda x: x.strftime('%Y-%m-%d %H:00'))]).sum()
-                ts_sum.to_csv('/home/hasitha/PycharmProjects/WrfSupport/output/' + s + '.csv')
-                print('--------------ts_sum : ', ts_sum)
-                _validate_ts(s, ts_sum, opts)
+def get_observed_store(fileNameList, store_dir=DESIGN_STORM_STORE_DIR):
+    # the station CSVs are converted once into the columnar store of design_storm, per set of files and contents
+    return design_storm.get_store([os.path.join(WRF_INPUT_DIR, fileName) for fileName in fileNameList], store_dir)
 
-        obs[s] = ts_sum
 
-    print('get_observed_precip|success')
-    return obs
-
-def get_observed_data_from_file(fileNameList):
-    oberserved_data = {}
-    for fileName in fileNameList:
-        station_ts = pd.read_csv('/home/hasitha/PycharmProjects/WrfSupport/input/' + fileName)
-        station_ts.set_index(['Time'], inplace=True)
-        station_key = fileName.split('.')[0]
-        oberserved_data[station_key] = station_ts
-    #print(oberserved_data)
-    return oberserved_data
-
-
-def design_rain_cell(run_date, run_time, kelani_lower_basin_points, kelani_lower_basin_shp, fileNameList):
+def design_rain_cell(run_date, run_time, kelani_lower_basin_points, kelani_lower_basin_shp, fileNameList,
+                     from_date_str='2016-05-18 00:00:00', to_date_str='2016-05-22 00:00:00', res_mins=10,
+                     obs_stations=None):
+    # RAINCELL.DAT of a single design storm, see design_storm for many scenarios at once
     #{'id' --> [lon, lat]}
-    # obs_stations = {'Colombo': [79.87203, 6.905, 'Leecom', 'wrf_79.87203_6.905'],
-    #                              'Glencourse': [80.19435, 6.977385, 'CUrW IoT', 'wrf_80.19435_6.977385'],
-    #                              'Hanwella': [80.08402, 6.91022, 'A&T Labs', 'wrf_80.08402_6.91022']}
-    obs_stations = {'Colombo': [79.87203, 6.905], 'Glencourse': [80.19435, 6.977385], 'Hanwella': [80.08402, 6.91022]}
-    points = np.genfromtxt(kelani_lower_basin_points, delimiter=',')
-    obs = get_observed_data_from_file(fileNameList)
-    print('generating thess_poly')
-    thess_poly = spatial_utils.get_voronoi_polygons(obs_stations, kelani_lower_basin_shp, add_total_area=False)
-    #print("stations : ", thess_poly[["id"]])
-    print("thess_poly : ", thess_poly)
-
+    if obs_stations is None:
+        obs_stations = design_storm.DEFAULT_STATIONS
     output_dir = os.path.join(WRF_OUTPUT_DIR, run_date + '_' + run_time)
-    if not os.path.exists(output_dir):
-        os.makedirs(output_dir)
-    output_file_path = os.path.join(output_dir, 'RAINCELL.DAT')
-    point_thess_idx = []
-    for point in points:
-        point_thess_idx.append(spatial_utils.is_inside_geo_df(thess_poly, lon=point[1], lat=point[2]))
-        pass
-
-    from_date_str = '2016-05-18 00:00:00'
-    to_date_str = '2016-05-22 00:00:00'
-
-    with open(output_file_path, 'w') as output_file:
-        print('from_date_str : ', from_date_str)
-        print('to_date_str : ', to_date_str)
-        from_date = dt.datetime.strptime(from_date_str, '%Y-%m-%d %H:%M:%S')
-        to_date = dt.datetime.strptime(to_date_str, '%Y-%m-%d %H:%M:%S')
-        duration_days = int((to_date-from_date).days)
-        res_mins = 10
-        print('res_mins : ', res_mins)
-        data_hours = int(duration_days * 24 * 60 / res_mins)
-        print('data_hours : ', data_hours)
-        #print('obs : ', obs)
-        output_file.write("%d %d %s %s\n" % (res_mins, data_hours, from_date, to_date))
-
-        for t in range(int(24 * 60 * duration_days / res_mins) + 1):
-            for i, point in enumerate(points):
-                rf = float(obs[point_thess_idx[i]].values[t]) if point_thess_idx[i] is not None else 0
-                output_file.write('%d %.1f\n' % (point[0], rf))
+    print('from_date_str : ', from_date_str)
+    print('to_date_str : ', to_date_str)
+    print('res_mins : ', res_mins)
+    run_metrics = metrics.set_metrics(metrics.Metrics())
+    with run_metrics.timer('total'):
+        engine = design_storm.DesignStormEngine(obs_stations, get_observed_store(fileNameList),
+                                                {'design': kelani_lower_basin_points}, kelani_lower_basin_shp,
+                                                mapping_cache_dir=MAPPING_CACHE_DIR)
+        engine.generate({'name': run_date + '_' + run_time, 'start': from_date_str, 'end': to_date_str,
+                         'res_mins': res_mins, 'stations': sorted(obs_stations), 'scale': 1.0}, output_dir)
+    run_metrics.print_summary()
 
 
 try:
@@ -0,0 +1,23 @@
+import numpy as np
+
+
+def get_bins(arr):
+    sz = len(arr)
+    return (arr[1:sz - 1] + arr[0:sz - 2]) / 2
+
+
+def get_wrf_cell_idx(points, lat_bins, lon_bins):
+    # (row, col) of the WRF cell for every point, computed once per run
+    rows = np.digitize(points[:, 2], lat_bins)
+    cols = np.digitize(points[:, 1], lon_bins)
+    return rows, cols
+
+
+def get_station_rf(obs, station_ids, steps, station_idx=None):
+    # obs maps station id -> series (or single column frame) of its rainfall.
+    # (time, station) rainfall of the first `steps` observed time steps, in the order of station_ids, of the
+    # stations of station_idx (default all). The extra last column stays 0
+    station_rf = np.zeros((steps, len(station_ids) + 1))
+    for j in (range(len(station_ids)) if station_idx is None else station_idx):
+        station_rf[:, j] = np.asarray(obs[station_ids[j]].values[:steps], dtype=float).reshape(steps, -1)[:, 0]
+    return station_rf
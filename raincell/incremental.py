@@ -0,0 +1,108 @@
+import hashlib
+import os
+from contextlib import nullcontext
+import numpy as np
+import mapping_cache
+import staging
+
+# Incremental regeneration of RAINCELL.DAT. Each time step of the file is keyed by its source : the observed hour
+# with the values of the stations at that hour, or the WRF rf file and time index of the forecast. A small sidecar
+# (npz) per model keeps the keys, offsets and sizes of the time steps of the last file written, so that the next run
+# copies the unchanged time steps from that file as they are, and only interpolates and formats the new ones.
+
+
+def get_run_key(points_file, obs_stations, shp_file, interpolation_schemes, res_mins, forecast_source, qc_key=None):
+    # everything besides the time steps which changes the rainfall of the points. qc_key : the
+    # qc.StationQC.get_key() of the quality control of the observations, None without one
+    sha1 = hashlib.sha1()
+    for part in (mapping_cache.file_digest(points_file), mapping_cache.get_stations_key(obs_stations),
+                 mapping_cache.file_digest(shp_file), tuple(interpolation_schemes), res_mins, forecast_source,
+                 qc_key):
+        sha1.update(str(part).encode('utf-8'))
+        sha1.update(b'|')
+    return sha1.hexdigest()
+
+
+def get_obs_keys(obs, steps):
+    # an hour is recomputed whenever any of its station values changed, e.g. an hour filled from the forecast for
+    # which the gauge data came in later
+    values = np.ascontiguousarray(obs.values[:steps], dtype=np.float64)
+    return ['obs|%s|%s' % (t, hashlib.sha1(row.tobytes()).hexdigest()) for t, row in zip(obs.index[:steps], values)]
+
+
+def get_forecast_keys(netcdf_file, forecast_start_idx, steps):
+    # the WRF rf file is identified by its size and modification time, a rerun of the same date rewrites it
+    stat = os.stat(netcdf_file)
+    source = '%s|%d|%d' % (os.path.abspath(netcdf_file), stat.st_size, stat.st_mtime_ns)
+    return ['wrf|%s|%d' % (source, forecast_start_idx + 1 + t) for t in range(steps)]
+
+
+def load_state(state_path, run_key):
+    # (previous RAINCELL.DAT, {step key: (offset, size)}) of the last run of a model, None if there is no usable one
+    if state_path is None or not os.path.exists(state_path):
+        return None
+    try:
+        with np.load(state_path, allow_pickle=False) as data:
+            if str(data['key']) != run_key:
+                return None
+            file_path, file_size = str(data['raincell_file']), int(data['raincell_size'])
+            keys, offsets, sizes = data['keys'], data['offsets'], data['sizes']
+    except (OSError, ValueError, KeyError) as e:
+        print('Ignoring unreadable incremental state %s : %s' % (state_path, e))
+        return None
+    # the previous file has to be the one the state was saved with
+    if not os.path.exists(file_path) or os.path.getsize(file_path) != file_size:
+        return None
+    return file_path, {str(k): (int(o), int(s)) for k, o, s in zip(keys, offsets, sizes) if k != ''}
+
+
+def save_state(state_path, run_key, file_path, keys, header_size, step_sizes):
+    sizes = np.asarray(step_sizes, dtype=np.int64)
+    offsets = header_size + np.concatenate([[0], np.cumsum(sizes)[:-1]])
+    keys = np.array(keys, dtype=str)
+
+    state_dir = os.path.dirname(state_path)
+    if state_dir and not os.path.exists(state_dir):
+        os.makedirs(state_dir)
+    with staging.atomic_write(state_path, 'wb') as f:
+        np.savez(f, key=np.array(run_key), raincell_file=np.array(os.path.abspath(file_path)),
+                 raincell_size=np.array(os.path.getsize(file_path)), keys=keys, offsets=offsets, sizes=sizes)
+
+
+def get_plan(keys, state):
+    # (start, end, copy) runs of consecutive time steps. copy is the (offset, [sizes]) of the run in the previous file,
+    # or None for the time steps to compute
+    steps = state[1] if state is not None else {}
+    plan = []
+    for i, key in enumerate(keys):
+        previous = steps.get(key)
+        if plan:
+            start, end, copy = plan[-1]
+            if previous is None and copy is None:
+                plan[-1] = (start, i + 1, None)
+                continue
+            # the copied runs have to be contiguous in the previous file too
+            if previous is not None and copy is not None and copy[0] + sum(copy[1]) == previous[0]:
+                plan[-1] = (start, i + 1, (copy[0], copy[1] + [previous[1]]))
+                continue
+        plan.append((i, i + 1, None if previous is None else (previous[0], [previous[1]])))
+    return plan
+
+
+def write_steps(writer, rainfall, plan, previous_file, chunk_steps):
+    # writes the time steps of plan, copying the unchanged ones from previous_file and interpolating the others
+    # from rainfall (see interpolation.SectionedRainfall)
+    with (open(previous_file, 'rb') if previous_file is not None else nullcontext()) as previous:
+        for start, end, copy in plan:
+            if copy is None:
+                for rf in rainfall.iter_chunks(chunk_steps, start, end):
+                    writer.write_steps(rf)
+                continue
+            offset, sizes = copy
+            previous.seek(offset)
+            # in chunks of chunk_steps, like the computed time steps
+            for i in range(0, len(sizes), chunk_steps):
+                chunk_sizes = sizes[i:i + chunk_steps]
+                writer.write_formatted_steps(previous.read(sum(chunk_sizes)).decode('ascii'), chunk_sizes)
+    return writer
+
@@ -0,0 +1,162 @@
+import numpy as np
+import numpy.ma as ma
+from scipy import sparse
+import grid_mapping
+import thiessen
+
+# Spatial interpolation of the station and WRF rainfall to the grid points, as a sparse (point, source) weight
+# matrix built once per run. A whole (time, source) block is then interpolated by a single sparse product.
+OBS_SCHEMES = ('thiessen', 'idw')
+FORECAST_SCHEMES = ('nearest', 'bilinear')
+
+
+def thiessen_weights(point_station_idx, n_stations):
+    # each point takes the rainfall of the station of its thiessen polygon, OUTSIDE points get an empty row (0)
+    inside = np.flatnonzero(point_station_idx != thiessen.OUTSIDE)
+    return sparse.csr_matrix((np.ones(len(inside)), (inside, point_station_idx[inside])),
+                             shape=(len(point_station_idx), n_stations))
+
+
+def idw_weights(points, station_coords, power=2, max_stations=None):
+    # inverse distance weights of the max_stations nearest stations (default all) of each point.
+    # station_coords : (station, 2) array of [lon, lat]. The longitude differences are scaled by cos(lat), which is
+    # close enough to the great circle distance at the size of a basin
+    station_coords = np.asarray(station_coords, dtype=float)
+    n_points, n_stations = len(points), len(station_coords)
+    dx = (points[:, 1, None] - station_coords[None, :, 0]) * np.cos(np.radians(points[:, 2, None]))
+    dy = points[:, 2, None] - station_coords[None, :, 1]
+    dist = np.hypot(dx, dy)
+
+    k = n_stations if max_stations is None else min(max_stations, n_stations)
+    cols = np.argpartition(dist, k - 1, axis=1)[:, :k] if k < n_stations else \
+        np.broadcast_to(np.arange(n_stations), (n_points, n_stations))
+    dist = np.take_along_axis(dist, cols, axis=1)
+
+    with np.errstate(divide='ignore'):
+        w = 1.0 / dist ** power
+    # a point on a station takes the rainfall of that station only
+    on_station = dist == 0
+    w[on_station.any(axis=1)] = on_station[on_station.any(axis=1)]
+    w /= w.sum(axis=1, keepdims=True)
+
+    rows = np.repeat(np.arange(n_points), k)
+    return sparse.csr_matrix((w.ravel(), (rows, cols.ravel())), shape=(n_points, n_stations))
+
+
+def nearest_cell_weights(rows, cols, n_rows, n_cols):
+    # each point takes the rainfall of its WRF cell, see grid_mapping.get_wrf_cell_idx
+    return sparse.csr_matrix((np.ones(len(rows)), (np.arange(len(rows)), rows * n_cols + cols)),
+                             shape=(len(rows), n_rows * n_cols))
+
+
+def bilinear_weights(points, lats, lons):
+    # bilinear interpolation between the centres of the 4 WRF cells around each point. lats and lons are the
+    # (ascending) axes of the WRF cells, the points beyond the outer cell centres take the edge values
+    def _axis_weights(values, axis):
+        i = np.clip(np.searchsorted(axis, values) - 1, 0, len(axis) - 2)
+        f = np.clip((values - axis[i]) / (axis[i + 1] - axis[i]), 0, 1)
+        return i, f
+
+    lats = np.asarray(lats, dtype=float)
+    lons = np.asarray(lons, dtype=float)
+    r, fy = _axis_weights(points[:, 2], lats)
+    c, fx = _axis_weights(points[:, 1], lons)
+
+    n_cols = len(lons)
+    cells = np.stack([r * n_cols + c, r * n_cols + c + 1, (r + 1) * n_cols + c, (r + 1) * n_cols + c + 1], axis=1)
+    w = np.stack([(1 - fy) * (1 - fx), (1 - fy) * fx, fy * (1 - fx), fy * fx], axis=1)
+    rows = np.repeat(np.arange(len(points)), 4)
+    return sparse.csr_matrix((w.ravel(), (rows, cells.ravel())), shape=(len(points), len(lats) * n_cols))
+
+
+def get_obs_weights(scheme, points, point_station_idx, station_ids, obs_stations):
+    # (point, station) weights, in the order of station_ids. Like the thiessen polygons, the interpolation is
+    # limited to the points within the basin
+    if scheme == 'thiessen':
+        return thiessen_weights(point_station_idx, len(station_ids))
+    elif scheme == 'idw':
+        station_coords = [obs_stations[s][0:2] for s in station_ids]
+        inside = (point_station_idx != thiessen.OUTSIDE).astype(float)
+        return sparse.diags(inside).dot(idw_weights(points, station_coords)).tocsr()
+    raise ValueError('Unknown observation interpolation %s, expected one of %s' % (scheme, OBS_SCHEMES))
+
+
+def get_forecast_weights(scheme, points, rows, cols, lats, lons, window=None):
+    # (point, WRF cell) weights over the lats x lons window, rows and cols being the cells of the points within it.
+    # window : (row slice, col slice) of the lats x lons cells the bilinear interpolation is limited to (default all),
+    # e.g. the area of a model, so that its weights do not depend on the areas of the other models read with it
+    if scheme == 'nearest':
+        return nearest_cell_weights(rows, cols, len(lats), len(lons))
+    elif scheme == 'bilinear':
+        if window is None:
+            return bilinear_weights(points, lats, lons)
+        row_slice, col_slice = window
+        weights = bilinear_weights(points, lats[row_slice], lons[col_slice]).tocoo()
+        window_rows, window_cols = np.divmod(weights.col, len(lons[col_slice]))
+        cells = (window_rows + row_slice.start) * len(lons) + window_cols + col_slice.start
+        return sparse.csr_matrix((weights.data, (weights.row, cells)), shape=(len(points), len(lats) * len(lons)))
+    raise ValueError('Unknown forecast interpolation %s, expected one of %s' % (scheme, FORECAST_SCHEMES))
+
+
+# rough peak memory of a point and time step while it is interpolated and formatted : the float32 value, the
+# float of .tolist() and its share of the formatted lines
+BYTES_PER_POINT_STEP = 64
+
+
+def get_chunk_steps(n_points, steps, memory_limit_mb=None):
+    # number of time steps interpolated and written at once, so that a chunk stays within memory_limit_mb.
+    # None keeps the whole window in a single chunk
+    if memory_limit_mb is None:
+        return max(steps, 1)
+    return int(min(max(memory_limit_mb * 1024 * 1024 // (n_points * BYTES_PER_POINT_STEP), 1), max(steps, 1)))
+
+
+def interpolate(weights, block):
+    # (time, source) block -> (time, point)
+    return weights.dot(np.asarray(block).T).T
+
+
+class SectionedRainfall:
+    # (time, point) rainfall of consecutive sections of time steps (e.g. the observed then the forecast ones), each
+    # interpolated from its own (time, source) series. Only the small source series are held in full, the point
+    # rainfall is interpolated on demand for a range of time steps. The WRF rainfall stays float32
+    def __init__(self, *sections):
+        # sections : (weights, source) of each section
+        self.sections = [(w.astype(np.result_type(src.dtype, np.float32), copy=False), src) for w, src in sections]
+        self.n_steps = sum(len(src) for w, src in self.sections)
+
+    def __len__(self):
+        return self.n_steps
+
+    def get_steps(self, start, end):
+        blocks = []
+        offset = 0
+        for weights, source in self.sections:
+            if start < offset + len(source) and end > offset:
+                blocks.append(interpolate(weights, source[max(start - offset, 0):end - offset]))
+            offset += len(source)
+        return np.concatenate(blocks)
+
+    def iter_chunks(self, chunk_steps, start=0, end=None):
+        end = self.n_steps if end is None else end
+        for i in range(start, end, chunk_steps):
+            yield self.get_steps(i, min(i + chunk_steps, end))
+
+
+def get_forecast_source(diff, forecast_start_idx, steps, diff_offset=0):
+    # (time, WRF cell) rainfall of the `steps` time steps following forecast_start_idx, steps past the end of the
+    # WRF run are filled with 0. diff may be a window of the whole de-accumulated series, starting at diff_offset
+    steps = max(steps, 0)
+    t_start = forecast_start_idx + 1 - diff_offset
+    t_idx = np.arange(max(t_start, 0), min(t_start + steps, len(diff)))
+
+    source = np.zeros((steps, int(np.prod(diff.shape[1:]))), dtype=diff.dtype)
+    if len(t_idx) > 0:
+        window = ma.getdata(diff[t_idx[0]:t_idx[-1] + 1])
+        source[t_idx[0] - t_start:t_idx[-1] - t_start + 1] = window.reshape(len(t_idx), -1)
+    return source
+
+
+def get_observed_source(obs, station_ids, steps):
+    # (time, station) rainfall of the first `steps` observed time steps, in the order of station_ids
+    return grid_mapping.get_station_rf(obs, station_ids, steps)[:, :len(station_ids)]
@@ -0,0 +1,168 @@
+import glob
+import hashlib
+import os
+import geopandas as gpd
+import numpy as np
+import grid_mapping
+import staging
+import thiessen
+
+# number of cache files of each kind (wrf_, thess_, voronoi_) kept in the cache directory, the least recently used
+# ones are evicted
+MAX_ENTRIES = 32
+
+
+def file_digest(path):
+    sha1 = hashlib.sha1()
+    with open(path, 'rb') as f:
+        for block in iter(lambda: f.read(1024 * 1024), b''):
+            sha1.update(block)
+    return sha1.hexdigest()
+
+
+def _shp_digest(shp_file):
+    # the geometry lives in the .shp, the polygon order in the .dbf
+    parts = [file_digest(shp_file)]
+    dbf_file = os.path.splitext(shp_file)[0] + '.dbf'
+    if os.path.exists(dbf_file):
+        parts.append(file_digest(dbf_file))
+    return ''.join(parts)
+
+
+def _get_key(*parts):
+    sha1 = hashlib.sha1()
+    for part in parts:
+        if isinstance(part, np.ndarray):
+            sha1.update(np.ascontiguousarray(part, dtype=np.float64).tobytes())
+        else:
+            sha1.update(str(part).encode('utf-8'))
+        sha1.update(b'|')
+    return sha1.hexdigest()
+
+
+def get_stations_key(obs_stations):
+    return sorted((s, float(obs_stations[s][0]), float(obs_stations[s][1])) for s in obs_stations.keys())
+
+
+def _load(path, key, n_points, names):
+    if not os.path.exists(path):
+        return None
+    try:
+        with np.load(path, allow_pickle=False) as data:
+            if str(data['key']) != key:
+                return None
+            arrays = {name: data[name] for name in names}
+    except (OSError, ValueError, KeyError) as e:
+        print('Ignoring unreadable mapping cache %s : %s' % (path, e))
+        return None
+    if n_points is not None and any(name != 'station_ids' and len(arrays[name]) != n_points for name in names):
+        return None
+    # the modification time of a cache file is its last use, see _evict
+    try:
+        os.utime(path, None)
+    except OSError:
+        pass
+    return arrays
+
+
+def _evict(cache_dir, prefix, max_entries=None):
+    max_entries = MAX_ENTRIES if max_entries is None else max_entries
+    paths = glob.glob(os.path.join(cache_dir, '%s_*.npz' % prefix))
+    if len(paths) <= max_entries:
+        return
+    paths.sort(key=lambda p: os.path.getmtime(p) if os.path.exists(p) else 0)
+    for path in paths[:len(paths) - max_entries]:
+        print('evicting mapping cache', path)
+        try:
+            os.remove(path)
+        except OSError:
+            pass
+
+
+def _save(path, **arrays):
+    cache_dir = os.path.dirname(path)
+    if not os.path.exists(cache_dir):
+        os.makedirs(cache_dir)
+    with staging.atomic_write(path, 'wb') as f:
+        np.savez(f, **arrays)
+    _evict(cache_dir, os.path.basename(path).split('_')[0])
+
+
+def get_wrf_mapping(cache_dir, points_file, points, lat_bins, lon_bins, refresh=False):
+    # (rows, cols) WRF cell indices of the points, see grid_mapping.get_wrf_cell_idx
+    if cache_dir is None:
+        return grid_mapping.get_wrf_cell_idx(points, lat_bins, lon_bins)
+
+    key = _get_key(file_digest(points_file), lat_bins, lon_bins)
+    path = os.path.join(cache_dir, 'wrf_%s.npz' % key)
+    cached = None if refresh else _load(path, key, len(points), ['rows', 'cols'])
+    if cached is not None:
+        return cached['rows'], cached['cols']
+
+    print('building wrf mapping cache', path)
+    rows, cols = grid_mapping.get_wrf_cell_idx(points, lat_bins, lon_bins)
+    _save(path, key=np.array(key), rows=rows, cols=cols)
+    return rows, cols
+
+
+def _get_voronoi_key(obs_stations, shp_file):
+    return _get_key(get_stations_key(obs_stations), _shp_digest(shp_file))
+
+
+def get_voronoi_polygons(cache_dir, obs_stations, shp_file, build_thess_poly, refresh=False):
+    # thiessen polygons of the stations, clipped to the basin. Only the id and the geometry of the polygons are cached,
+    # keyed by the station coordinates and the shape file, so that they are only rebuilt when a station drops out or
+    # comes back. build_thess_poly() is only called on a cache miss
+    if cache_dir is None:
+        return build_thess_poly()
+
+    key = _get_voronoi_key(obs_stations, shp_file)
+    path = os.path.join(cache_dir, 'voronoi_%s.npz' % key)
+    cached = None if refresh else _load(path, key, None, ['ids', 'wkb', 'wkb_offsets', 'crs'])
+    if cached is not None:
+        wkb, offsets = cached['wkb'].tobytes(), cached['wkb_offsets']
+        geometry = gpd.GeoSeries.from_wkb([wkb[offsets[i]:offsets[i + 1]] for i in range(len(offsets) - 1)])
+        return gpd.GeoDataFrame({'id': [str(s) for s in cached['ids']]}, geometry=geometry,
+                                crs=str(cached['crs']) or None)
+
+    print('building voronoi polygons cache', path)
+    thess_poly = build_thess_poly()
+    wkb = [g.wkb for g in thess_poly['geometry']]
+    crs = thess_poly.crs.to_wkt() if thess_poly.crs is not None else ''
+    _save(path, key=np.array(key), ids=np.array([str(s) for s in thess_poly['id']], dtype=str),
+          wkb=np.frombuffer(b''.join(wkb), dtype=np.uint8), wkb_offsets=np.cumsum([0] + [len(b) for b in wkb]),
+          crs=np.array(crs))
+    return thess_poly
+
+
+def _get_thiessen_key(points_file, obs_stations, shp_file):
+    # the point assignments are keyed alongside the polygons they come from
+    return _get_key(file_digest(points_file), _get_voronoi_key(obs_stations, shp_file))
+
+
+def has_thiessen_mapping(cache_dir, points_file, points, obs_stations, shp_file):
+    if cache_dir is None:
+        return False
+    key = _get_thiessen_key(points_file, obs_stations, shp_file)
+    path = os.path.join(cache_dir, 'thess_%s.npz' % key)
+    return _load(path, key, len(points), ['point_idx', 'station_ids']) is not None
+
+
+def get_thiessen_mapping(cache_dir, points_file, points, obs_stations, shp_file, build_thess_poly, refresh=False):
+    # (point_thess_idx, station_ids), see thiessen.assign_points. build_thess_poly() is only called on a cache miss
+    if cache_dir is None:
+        thess_poly = build_thess_poly()
+        return thiessen.assign_points(points, thess_poly), thiessen.get_station_ids(thess_poly)
+
+    key = _get_thiessen_key(points_file, obs_stations, shp_file)
+    path = os.path.join(cache_dir, 'thess_%s.npz' % key)
+    cached = None if refresh else _load(path, key, len(points), ['point_idx', 'station_ids'])
+    if cached is not None:
+        return cached['point_idx'], [str(s) for s in cached['station_ids']]
+
+    print('building thiessen mapping cache', path)
+    thess_poly = build_thess_poly()
+    point_idx = thiessen.assign_points(points, thess_poly)
+    station_ids = thiessen.get_station_ids(thess_poly)
+    _save(path, key=np.array(key), point_idx=point_idx, station_ids=np.array(station_ids, dtype=str))
+    return point_idx, station_ids
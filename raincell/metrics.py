@@ -0,0 +1,152 @@
+import cProfile
+import datetime as dt
+import json
+import os
+import pstats
+import threading
+import time
+import tracemalloc
+from contextlib import contextmanager
+
+
+class _Timer:
+    __slots__ = ('metrics', 'stage', 'start')
+
+    def __init__(self, metrics, stage):
+        self.metrics = metrics
+        self.stage = stage
+
+    def __enter__(self):
+        self.start = time.perf_counter()
+        return self
+
+    def __exit__(self, exc_type, exc_val, exc_tb):
+        self.metrics.add_time(self.stage, time.perf_counter() - self.start)
+        return False
+
+
+class _NullTimer:
+    def __enter__(self):
+        return self
+
+    def __exit__(self, exc_type, exc_val, exc_tb):
+        return False
+
+
+class Metrics:
+    # Per stage timers and counters of a run, e.g.
+    #     with metrics.get_metrics().timer('netcdf_read'):
+    #         ...
+    #     metrics.get_metrics().count('obs_rows_fetched', len(ts))
+    enabled = True
+
+    def __init__(self):
+        self.timers = {}
+        self.counters = {}
+        # the observations are fetched from several threads
+        self._lock = threading.Lock()
+
+    def timer(self, stage):
+        return _Timer(self, stage)
+
+    def add_time(self, stage, seconds):
+        with self._lock:
+            timer = self.timers.setdefault(stage, {'seconds': 0.0, 'calls': 0})
+            timer['seconds'] += seconds
+            timer['calls'] += 1
+
+    def count(self, name, n=1):
+        with self._lock:
+            self.counters[name] = self.counters.get(name, 0) + n
+
+    def merge(self, other, prefix=''):
+        # other : Metrics, or its to_dict() (e.g. returned by a worker process)
+        other = other.to_dict() if isinstance(other, Metrics) else other
+        for stage, timer in other['timers'].items():
+            with self._lock:
+                merged = self.timers.setdefault(prefix + stage, {'seconds': 0.0, 'calls': 0})
+                merged['seconds'] += timer['seconds']
+                merged['calls'] += timer['calls']
+        for name, n in other['counters'].items():
+            self.count(prefix + name, n)
+
+    def to_dict(self):
+        return {'timers': self.timers, 'counters': self.counters}
+
+    def dump(self, path, **context):
+        # appends the metrics of the run as one JSON line
+        record = {'time': dt.datetime.now().strftime('%Y-%m-%d %H:%M:%S')}
+        record.update(context)
+        record.update(self.to_dict())
+        with open(path, 'a') as metrics_file:
+            metrics_file.write(json.dumps(record) + '\n')
+
+    def print_summary(self):
+        for stage, timer in sorted(self.timers.items(), key=lambda x: -x[1]['seconds']):
+            print('metrics|%-30s %10.3fs (%d calls)' % (stage, timer['seconds'], timer['calls']))
+        for name, n in sorted(self.counters.items()):
+            print('metrics|%-30s %d' % (name, n))
+
+
+class NullMetrics(Metrics):
+    # used while metrics are disabled, all the calls are no-ops
+    enabled = False
+    _null_timer = _NullTimer()
+
+    def timer(self, stage):
+        return self._null_timer
+
+    def add_time(self, stage, seconds):
+        pass
+
+    def count(self, name, n=1):
+        pass
+
+    def merge(self, other, prefix=''):
+        pass
+
+
+NULL_METRICS = NullMetrics()
+_metrics = NULL_METRICS
+
+
+def get_metrics():
+    return _metrics
+
+
+def set_metrics(metrics):
+    global _metrics
+    _metrics = metrics if metrics is not None else NULL_METRICS
+    return _metrics
+
+
+@contextmanager
+def profiling(mode, output_path):
+    # mode : None, 'cprofile' (pstats dump of the block) or 'tracemalloc' (top allocations and peak of the block)
+    if mode is None:
+        yield
+        return
+    if mode == 'cprofile':
+        profile = cProfile.Profile()
+        profile.enable()
+        try:
+            yield
+        finally:
+            profile.disable()
+            profile.dump_stats(output_path)
+            pstats.Stats(profile).sort_stats('cumulative').print_stats(20)
+    elif mode == 'tracemalloc':
+        tracemalloc.start()
+        try:
+            yield
+        finally:
+            snapshot = tracemalloc.take_snapshot()
+            current, peak = tracemalloc.get_traced_memory()
+            tracemalloc.stop()
+            with open(output_path, 'w') as output_file:
+                output_file.write('current %.1f MB, peak %.1f MB\n' % (current / 1e6, peak / 1e6))
+                for stat in snapshot.statistics('lineno')[:30]:
+                    output_file.write('%s\n' % stat)
+            print('profiling|tracemalloc peak %.1f MB, see %s' % (peak / 1e6, os.path.abspath(output_path)))
+    else:
+        raise ValueError('Unknown profiling mode %s' % mode)
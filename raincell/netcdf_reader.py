@@ -0,0 +1,80 @@
+import os
+import numpy as np
+import numpy.ma as ma
+from netCDF4 import Dataset
+import metrics
+
+
+class WrfRfReader:
+    # Lazy reader of a WRF `_rf` NetCDF file. Only the Times, the lat/lon axes and the requested time x lat x lon
+    # hyperslabs of RAINC/RAINNC are read from the file, which keeps the reads small on the NFS mount.
+    # Same conventions as ext_utils.extract_area_rf_series: diff[i] is the rainfall from times[i] to times[i + 1]
+    def __init__(self, nc_f):
+        if not os.path.exists(nc_f):
+            raise IOError('File %s not found' % nc_f)
+        self.nc_f = nc_f
+        self.nc_fid = Dataset(nc_f, 'r')
+        times = self.nc_fid.variables['Times'][:]
+        self.all_times = np.array([b''.join(np.asarray(x)).decode() for x in times])
+        # times of the de-accumulated series
+        self.times = self.all_times[0:len(self.all_times) - 1]
+        self.lat_slice = slice(None)
+        self.lon_slice = slice(None)
+        self._all_lats = self.nc_fid.variables['XLAT'][0, :, 0]
+        self._all_lons = self.nc_fid.variables['XLONG'][0, 0, :]
+        self.lats = self._all_lats
+        self.lons = self._all_lons
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, exc_type, exc_val, exc_tb):
+        self.close()
+
+    def get_area_slices(self, lat_min, lat_max, lon_min, lon_max):
+        lats = self._all_lats
+        lons = self._all_lons
+
+        lon_min_idx = np.argmax(lons >= lon_min) - 1
+        lat_min_idx = np.argmax(lats >= lat_min) - 1
+        lon_max_idx = np.argmax(lons >= lon_max)
+        lat_max_idx = np.argmax(lats >= lat_max)
+
+        return slice(lat_min_idx, lat_max_idx), slice(lon_min_idx, lon_max_idx)
+
+    def set_slices(self, lat_slice, lon_slice):
+        self.lat_slice = lat_slice
+        self.lon_slice = lon_slice
+        self.lats = self._all_lats[lat_slice]
+        self.lons = self._all_lons[lon_slice]
+
+    def set_area(self, lat_min, lat_max, lon_min, lon_max):
+        self.set_slices(*self.get_area_slices(lat_min, lat_max, lon_min, lon_max))
+
+    def get_axes(self, lat_slice, lon_slice):
+        return self._all_lats[lat_slice], self._all_lons[lon_slice]
+
+    def get_time_idx(self, time_str):
+        # index of a '%Y-%m-%d_%H:%M:%S' time stamp in self.times
+        idx = np.where(self.times == time_str)[0]
+        if len(idx) == 0:
+            raise ValueError('%s is not within the times of %s' % (time_str, self.nc_f))
+        return int(idx[0])
+
+    def read_diff(self, start_idx, end_idx):
+        # diff[start_idx:end_idx] of the area, clipped to the length of the run. Reads end_idx - start_idx + 1
+        # accumulated time steps only
+        start_idx = max(start_idx, 0)
+        end_idx = min(end_idx, len(self.times))
+        if end_idx <= start_idx:
+            return ma.zeros((0, len(self.lats), len(self.lons)), dtype=np.float32)
+
+        t_slice = slice(start_idx, end_idx + 1)
+        prcp = self.nc_fid.variables['RAINC'][t_slice, self.lat_slice, self.lon_slice] + \
+            self.nc_fid.variables['RAINNC'][t_slice, self.lat_slice, self.lon_slice]
+        # RAINC and RAINNC
+        metrics.get_metrics().count('netcdf_bytes_read', 2 * prcp.data.nbytes)
+        return ma.diff(prcp, axis=0)
+
+    def close(self):
+        self.nc_fid.close()
@@ -0,0 +1,129 @@
+import datetime as dt
+import sqlite3
+import threading
+
+TIME_FORMAT = '%Y-%m-%d %H:%M:%S'
+# trailing hours of the cached coverage fetched again, whose readings may still be revised or come in late
+REVISION_HOURS = 3
+
+
+def _floor_hour(d):
+    return d.replace(minute=0, second=0, microsecond=0)
+
+
+class ObservationCache:
+    # Local SQLite store of the station series fetched from the CUrW database, keyed by station, variable, type and
+    # source. `coverage` keeps the [start, end] period each series is known for, whether or not it had data.
+    # Data older than max_days before the newest requested time is evicted.
+    def __init__(self, db_path, max_days=5):
+        self.db_path = db_path
+        self.max_days = max_days
+        self._lock = threading.Lock()
+        self._conn = sqlite3.connect(db_path, check_same_thread=False)
+        with self._conn:
+            self._conn.execute('CREATE TABLE IF NOT EXISTS ts (station TEXT, variable TEXT, type TEXT, source TEXT, '
+                               'time TEXT, value REAL, PRIMARY KEY (station, variable, type, source, time))')
+            self._conn.execute('CREATE TABLE IF NOT EXISTS coverage (station TEXT, variable TEXT, type TEXT, '
+                               'source TEXT, start TEXT, end TEXT, PRIMARY KEY (station, variable, type, source))')
+
+    @staticmethod
+    def get_key(meta):
+        return meta['station'], meta['variable'], meta['type'], meta['source']
+
+    def get_coverage(self, key):
+        with self._lock:
+            row = self._conn.execute('SELECT start, end FROM coverage WHERE station=? AND variable=? AND type=? '
+                                     'AND source=?', key).fetchone()
+        if row is None:
+            return None
+        return dt.datetime.strptime(row[0], TIME_FORMAT), dt.datetime.strptime(row[1], TIME_FORMAT)
+
+    def put(self, key, timeseries, start, end, coverage):
+        # replaces the cached values of [start, end] with timeseries, and sets the coverage of the series
+        rows = [key + (t.strftime(TIME_FORMAT), float(v)) for t, v in timeseries]
+        with self._lock, self._conn:
+            self._conn.execute('DELETE FROM ts WHERE station=? AND variable=? AND type=? AND source=? '
+                               'AND time>=? AND time<=?', key + (start.strftime(TIME_FORMAT), end.strftime(TIME_FORMAT)))
+            self._conn.executemany('INSERT OR REPLACE INTO ts VALUES (?, ?, ?, ?, ?, ?)', rows)
+            self._conn.execute('INSERT OR REPLACE INTO coverage VALUES (?, ?, ?, ?, ?, ?)',
+                               key + (coverage[0].strftime(TIME_FORMAT), coverage[1].strftime(TIME_FORMAT)))
+
+    def get(self, key, start, end):
+        with self._lock:
+            rows = self._conn.execute('SELECT time, value FROM ts WHERE station=? AND variable=? AND type=? '
+                                      'AND source=? AND time>=? AND time<=? ORDER BY time',
+                                      key + (start.strftime(TIME_FORMAT), end.strftime(TIME_FORMAT))).fetchall()
+        return [[dt.datetime.strptime(t, TIME_FORMAT), v] for t, v in rows]
+
+    def evict(self, key, latest):
+        cutoff = (latest - dt.timedelta(days=self.max_days)).strftime(TIME_FORMAT)
+        with self._lock, self._conn:
+            self._conn.execute('DELETE FROM ts WHERE station=? AND variable=? AND type=? AND source=? AND time<?',
+                               key + (cutoff,))
+            self._conn.execute('UPDATE coverage SET start=? WHERE station=? AND variable=? AND type=? AND source=? '
+                               'AND start<?', (cutoff,) + key + (cutoff,))
+
+    def close(self):
+        with self._lock:
+            self._conn.close()
+
+
+def _first_empty_hour(timeseries, start, end):
+    # first hour of [start, end] without any cached reading, None if there is none
+    hours = set(_floor_hour(t) for t, _ in timeseries)
+    hour = _floor_hour(start)
+    while hour <= end:
+        if hour not in hours:
+            return max(hour, start)
+        hour += dt.timedelta(hours=1)
+    return None
+
+
+class CachedAdapter:
+    # Wraps a MySQLAdapter so that retrieve_timeseries only queries the hours after the cached high-water mark of
+    # the series and serves the rest of the window from the ObservationCache. Gauge data may come in late, so the
+    # query also covers the last revision_hours cached hours, and the window from the hour before the first one
+    # without any cached reading.
+    def __init__(self, adapter, cache, cached_types=('Observed',), revision_hours=REVISION_HOURS):
+        self.adapter = adapter
+        self.cache = cache
+        self.cached_types = cached_types
+        self.revision_hours = revision_hours
+
+    def retrieve_timeseries(self, meta, opts):
+        if meta['type'] not in self.cached_types:
+            return self.adapter.retrieve_timeseries(meta, opts)
+
+        key = self.cache.get_key(meta)
+        start = dt.datetime.strptime(opts['from'], TIME_FORMAT)
+        end = dt.datetime.strptime(opts['to'], TIME_FORMAT)
+
+        coverage = self.cache.get_coverage(key)
+        if coverage is not None and coverage[0] <= start <= coverage[1]:
+            covered_end = min(coverage[1], end)
+            fetch_start = max(start, _floor_hour(coverage[1]) - dt.timedelta(hours=max(self.revision_hours - 1, 0)))
+            empty_hour = _first_empty_hour(self.cache.get(key, start, covered_end), start, covered_end)
+            if empty_hour is not None:
+                # along with the hour before it, which may have been incomplete like the last cached one
+                fetch_start = min(fetch_start, max(start, empty_hour - dt.timedelta(hours=1)))
+            new_coverage = (coverage[0], max(coverage[1], end))
+        else:
+            fetch_start = start
+            new_coverage = (start, end) if coverage is None or coverage[1] < start or coverage[0] > end \
+                else (start, max(coverage[1], end))
+
+        if fetch_start <= end:
+            fetch_opts = dict(opts)
+            fetch_opts['from'] = fetch_start.strftime(TIME_FORMAT)
+            row_ts = self.adapter.retrieve_timeseries(meta, fetch_opts)
+            timeseries = row_ts[0]['timeseries'] if len(row_ts) > 0 else []
+            self.cache.put(key, timeseries, fetch_start, end, new_coverage)
+            self.cache.evict(key, new_coverage[1])
+
+        timeseries = self.cache.get(key, start, end)
+        if len(timeseries) == 0:
+            return []
+        return [{'timeseries': timeseries}]
+
+    def close(self):
+        self.adapter.close()
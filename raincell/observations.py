@@ -0,0 +1,287 @@
+import os
+import queue
+import threading
+import time
+from concurrent.futures import Future
+from contextlib import contextmanager
+import numpy as np
+import pandas as pd
+import metrics
+
+
+class CurwObservationException(Exception):
+    pass
+
+
+# seconds a request waits for a free connection of an AdapterPool, and between its checks for an abandoned one
+ACQUIRE_TIMEOUT = 300
+ACQUIRE_POLL = 1.0
+
+
+class AdapterPool:
+    # A small pool of MySQLAdapter connections, shared by the threads fetching the station series.
+    # adapter_factory() opens a new connection; anything with retrieve_timeseries(meta, opts) works (e.g. a fake
+    # adapter serving local series). A long running process can set max_idle (seconds), so that the connections
+    # idle for longer (e.g. dropped by the MySQL wait_timeout) are reopened, instead of failing the next query.
+    # A request waiting for a connection for longer than acquire_timeout (seconds) fails with a
+    # CurwObservationException
+    def __init__(self, adapter_factory, size=4, max_idle=None, acquire_timeout=ACQUIRE_TIMEOUT):
+        self.adapter_factory = adapter_factory
+        self.size = size
+        self.max_idle = max_idle
+        self.acquire_timeout = acquire_timeout
+        # (adapter, time it was released)
+        self._idle = queue.LifoQueue()
+        self._adapters = []
+        # adapters handed out by connection() and not yet released
+        self._held = []
+        self._lock = threading.Lock()
+
+    @classmethod
+    def of(cls, adapter):
+        # wraps a single already open adapter, which then serves one request at a time
+        pool = cls(None, size=1)
+        pool._adapters.append(adapter)
+        pool._idle.put((adapter, time.time()))
+        return pool
+
+    def _discard(self, adapter):
+        with self._lock:
+            if adapter in self._adapters:
+                self._adapters.remove(adapter)
+        try:
+            adapter.close()
+        except Exception:
+            pass
+
+    def _hold(self, adapter):
+        with self._lock:
+            self._held.append(adapter)
+        return adapter
+
+    def _acquire(self):
+        deadline = None if self.acquire_timeout is None else time.monotonic() + self.acquire_timeout
+        while True:
+            with self._lock:
+                can_open = self.adapter_factory is not None and len(self._adapters) < self.size
+            try:
+                if can_open:
+                    adapter, released = self._idle.get_nowait()
+                else:
+                    # waits for a released adapter, checking now and then for the room of an abandoned one
+                    timeout = ACQUIRE_POLL if deadline is None else min(deadline - time.monotonic(), ACQUIRE_POLL)
+                    if timeout <= 0:
+                        raise CurwObservationException(
+                            'No database connection free within %s seconds' % self.acquire_timeout)
+                    adapter, released = self._idle.get(timeout=timeout)
+            except queue.Empty:
+                if not can_open:
+                    continue
+                with self._lock:
+                    if len(self._adapters) < self.size:
+                        adapter = self.adapter_factory()
+                        self._adapters.append(adapter)
+                        self._held.append(adapter)
+                        return adapter
+                continue
+            if self.max_idle is None or self.adapter_factory is None or time.time() - released <= self.max_idle:
+                return self._hold(adapter)
+            self._discard(adapter)
+
+    def _release(self, adapter, broken=False):
+        with self._lock:
+            if adapter in self._held:
+                self._held.remove(adapter)
+            abandoned = adapter not in self._adapters
+        # the connection may be broken, a new one is opened for the next request
+        if abandoned or (broken and self.adapter_factory is not None):
+            self._discard(adapter)
+        else:
+            self._idle.put((adapter, time.time()))
+
+    @contextmanager
+    def connection(self):
+        adapter = self._acquire()
+        try:
+            yield adapter
+        except Exception:
+            self._release(adapter, broken=True)
+            raise
+        self._release(adapter)
+
+    def abandon_held(self):
+        # Gives up on the adapters still held, e.g. by the requests of a stage which timed out and may never return.
+        # New connections are opened in their place, and each abandoned adapter is closed when (if) it is released.
+        # An adapter wrapped with AdapterPool.of cannot be replaced, and is kept
+        if self.adapter_factory is None:
+            return 0
+        with self._lock:
+            abandoned = [a for a in self._held if a in self._adapters]
+            for adapter in abandoned:
+                self._adapters.remove(adapter)
+        if abandoned:
+            print('AdapterPool|abandoned %d held connection(s)' % len(abandoned))
+        return len(abandoned)
+
+    def close(self):
+        with self._lock:
+            for adapter in self._adapters:
+                adapter.close()
+            self._adapters = []
+            self._held = []
+            while not self._idle.empty():
+                self._idle.get_nowait()
+        print("Mysql connection pool closed.")
+
+
+def to_series(ts):
+    # [[datetime, value], ...] rows, as returned by retrieve_timeseries, to a float series on a DatetimeIndex
+    if len(ts) == 0:
+        return pd.Series(dtype=float, index=pd.DatetimeIndex([]))
+    ts = np.asarray(ts)
+    return pd.Series(ts[:, 1].astype(float), index=pd.DatetimeIndex(ts[:, 0]))
+
+
+def frame_to_series(df):
+    # first column of a frame indexed by time stamps (e.g. a station CSV read with the `Time` column as index)
+    return pd.Series(df.iloc[:, 0].astype(float).values, index=pd.to_datetime(df.index))
+
+
+def aggregate_ts(series, start_dt, periods, freq='h'):
+    # Sum of the readings within each `freq` interval, labelled by the interval start, on the expected range of
+    # `periods` intervals from start_dt. Intervals without any reading are NaN.
+    expected = pd.date_range(start_dt, periods=periods, freq=freq)
+    if len(series) == 0:
+        return pd.Series(np.nan, index=expected)
+    summed = series.sort_index().resample(freq, closed='left', label='left').sum(min_count=1)
+    return summed.reindex(expected)
+
+
+def is_complete(series):
+    return not series.isna().any()
+
+
+def fill_gaps(series, fallback):
+    # fills the missing intervals of series from the values of fallback at the same time stamps
+    if fallback is None or is_complete(series):
+        return series
+    return series.fillna(fallback.reindex(series.index))
+
+
+def _daemon_map(func, items, max_workers):
+    # like ThreadPoolExecutor.map, but on daemon threads, so that a query which never returns does not keep the
+    # process alive once the caller gave up on it (see pipeline.STAGE_TIMEOUTS)
+    futures = [Future() for _ in items]
+    todo = queue.Queue()
+    for i in range(len(items)):
+        todo.put(i)
+
+    def _worker():
+        while True:
+            try:
+                i = todo.get_nowait()
+            except queue.Empty:
+                return
+            try:
+                futures[i].set_result(func(items[i]))
+            except BaseException as e:
+                futures[i].set_exception(e)
+
+    for _ in range(min(max_workers, len(items))):
+        threading.Thread(target=_worker, daemon=True).start()
+    return [f.result() for f in futures]
+
+
+def get_observed_precip(obs_stations, start_dt, end_dt, duration_days, adapter, forecast_source='wrf0',
+                        max_workers=None, dump_dir=None, qc=None, return_report=False):
+    # Fetches the hourly observed precipitation of all obs_stations concurrently, filling the missing hours from the
+    # `Forecast-0-d` series of the station. Returns a DataFrame of hourly rows (DatetimeIndex) by station.
+    # adapter is either an AdapterPool or a single adapter
+    # qc : a qc.StationQC, whose flagged hours are filled from the `Forecast-0-d` series like the missing ones.
+    # With return_report, returns (observations, QC report), the report being None without qc
+    pool = adapter if isinstance(adapter, AdapterPool) else AdapterPool.of(adapter)
+    run_metrics = metrics.get_metrics()
+    n_hours = duration_days[0] * 24 + 1
+    opts = {
+        'from': start_dt.strftime('%Y-%m-%d %H:%M:%S'),
+        'to': end_dt.strftime('%Y-%m-%d %H:%M:%S'),
+    }
+
+    def _validate_ts(_s, _ts_sum, _opts):
+        if is_complete(_ts_sum):
+            return _ts_sum
+
+        f_station = {'station': obs_stations[_s][3],
+                     'variable': 'Precipitation',
+                     'unit': 'mm',
+                     'type': 'Forecast-0-d',
+                     'source': forecast_source,
+                     }
+        with pool.connection() as _adapter, run_metrics.timer('obs_query'):
+            f_row_ts = _adapter.retrieve_timeseries(f_station, _opts)
+        run_metrics.count('obs_forecast_fallbacks')
+        f_ts = to_series(f_row_ts[0]['timeseries'] if len(f_row_ts) > 0 else [])
+        run_metrics.count('obs_rows_fetched', len(f_ts))
+
+        _ts_sum = fill_gaps(_ts_sum, aggregate_ts(f_ts, start_dt, n_hours))
+        if is_complete(_ts_sum):
+            return _ts_sum
+        else:
+            raise CurwObservationException('%s Forecast time-series validation failed' % _s)
+
+    def _get_station_precip(s):
+        station = {'station': s,
+                   'variable': 'Precipitation',
+                   'unit': 'mm',
+                   'type': 'Observed',
+                   'source': 'WeatherStation',
+                   'name': obs_stations[s][2]
+                   }
+        with pool.connection() as _adapter, run_metrics.timer('obs_query'):
+            row_ts = _adapter.retrieve_timeseries(station, opts)
+        ts = row_ts[0]['timeseries'] if len(row_ts) > 0 else []
+        run_metrics.count('obs_rows_fetched', len(ts))
+        if len(ts) == 0:
+            run_metrics.count('obs_empty_stations')
+        ts_sum = aggregate_ts(to_series(ts), start_dt, n_hours)
+        if dump_dir is not None:
+            ts_sum.to_csv(os.path.join(dump_dir, s + '.csv'))
+        return ts_sum.rename(s), len(ts)
+
+    stations = list(obs_stations.keys())
+    max_workers = max_workers or pool.size
+    # the workers only count, the stations are reported once all of them are fetched
+    with run_metrics.timer('obs_fetch'):
+        fetched = _daemon_map(_get_station_precip, stations, max_workers)
+    obs = pd.concat([ts_sum for ts_sum, _ in fetched], axis=1)
+    print('get_observed_precip|%d stations from %s to %s, rows %s' % (
+        len(stations), opts['from'], opts['to'], {s: n for s, (_, n) in zip(stations, fetched)}))
+    empty = [s for s, (_, n) in zip(stations, fetched) if n == 0]
+    if empty:
+        print('get_observed_precip|no data for %s' % empty)
+
+    report = None
+    if qc is not None:
+        with run_metrics.timer('obs_qc'):
+            obs, report = qc.apply(obs)
+        run_metrics.count('obs_qc_flagged', report['flagged'])
+        for s, station_report in report['stations'].items():
+            print('%s : %d hours flagged by QC %s' % (s, len(station_report['hours']),
+                                                      {c: n for c, n in station_report.items() if c != 'hours' and n}))
+
+    # the stations with missing (or flagged) hours are filled from their forecast, all at once after the QC
+    incomplete = [s for s in stations if not is_complete(obs[s])]
+    missing = {s: int(obs[s].isna().sum()) for s in incomplete}
+    if report is not None:
+        report['filled'] = missing
+    with run_metrics.timer('obs_fallback'):
+        filled = _daemon_map(lambda s: _validate_ts(s, obs[s], opts), incomplete, max_workers)
+    if missing:
+        print('get_observed_precip|missing hours filled from %s %s' % (forecast_source, missing))
+    for s, ts in zip(incomplete, filled):
+        obs[s] = ts
+
+    print('get_observed_precip|success')
+    if return_report:
+        return obs, report
+    return obs
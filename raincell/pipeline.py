@@ -0,0 +1,405 @@
+import datetime as dt
+import os
+import threading
+import time
+from concurrent.futures import Future, ProcessPoolExecutor, TimeoutError as FutureTimeoutError
+import numpy as np
+from curw.rainfall.wrf.extraction import spatial_utils
+from curw.rainfall.wrf import utils
+import catchments
+import grid_mapping
+import incremental
+import interpolation
+import mapping_cache
+import metrics
+import netcdf_reader
+import observations
+import raincell_writer
+import staging
+
+# points file of each FLO-2D model, within WRF_DATA_DIR
+MODEL_POINTS = {
+    '30m': 'kelani_basin_points_30m.txt',
+    '150m': 'klb_glecourse_points_150m.txt',
+    '250m': 'kelani_basin_points_250m.txt',
+}
+
+# observation stations : {name: [lon, lat, source, name of the Forecast-0-d series of its WRF cell]}
+OBS_STATIONS = {'Kottawa North Dharmapala School': [79.95818, 6.865576, 'Leecom', 'wrf_79.957123_6.859688'],
+                'IBATTARA2': [79.919, 6.908, 'CUrW IoT', 'wrf_79.902664_6.913757'],
+                'Malabe': [79.95738, 6.90396, 'A&T Labs', 'wrf_79.957123_6.913757'],
+                'Kotikawatta': [80.802551, 6.890585, 'Leecom', 'wrf_80.802551_6.890585'],
+                'Mulleriyawa': [79.941176, 6.923571, 'A&T Labs', 'wrf_79.929893_6.913757'],
+                'Orugodawatta': [79.87887, 6.943741, 'CUrW IoT', 'wrf_79.87887_6.943741']}
+
+QC_REPORT_FILE = 'QC_REPORT.json'
+
+# seconds each of the concurrent stages of generate_raincells may take, None waits for ever
+STAGE_TIMEOUTS = {
+    'netcdf_read': 900,
+    'voronoi': 600,
+    'obs_fetch': 600,
+}
+
+
+def check_tags(net_cdf_path, tags):
+    # raises ValueError for the tags other than the default wrf0 run when NET_CDF_PATH has no {tag} placeholder, as
+    # all of them would read the rf files of that run
+    other_tags = sorted(set(t or 'wrf0' for t in tags) - {'wrf0'})
+    if '{tag}' not in net_cdf_path and other_tags:
+        raise ValueError('NET_CDF_PATH %s has no {tag} placeholder for the tags %s' % (net_cdf_path, other_tags))
+
+
+def get_netcdf_file(net_cdf_path, run_date, tag=''):
+    # WRF rf file of the run of the day before run_date. NET_CDF_PATH may hold a {tag} placeholder for the
+    # simultaneous forecast runs, e.g. '/mnt/disks/curwsl_nfs_1/results/{tag}_', see check_tags
+    check_tags(net_cdf_path, [tag])
+    net_cdf_date = dt.datetime.strptime(run_date, '%Y-%m-%d') - dt.timedelta(hours=24)
+    net_cdf_date = net_cdf_date.strftime("%Y-%m-%d")
+    return net_cdf_path.format(tag=tag or 'wrf0') + net_cdf_date + '_18:00_0000/wrf/wrfout_d03_' + net_cdf_date + \
+        '_18:00:00_rf'
+
+
+def get_netcdf_glob(net_cdf_path, tag=''):
+    # glob of the WRF rf files of all the run dates, see get_netcdf_file
+    check_tags(net_cdf_path, [tag])
+    return net_cdf_path.format(tag=tag or 'wrf0') + '*_18:00_0000/wrf/wrfout_d03_*_18:00:00_rf'
+
+
+def get_run_date(netcdf_file):
+    # run date of a WRF rf file, the inverse of get_netcdf_file
+    net_cdf_date = os.path.basename(netcdf_file)[len('wrfout_d03_'):len('wrfout_d03_YYYY-MM-DD')]
+    return (dt.datetime.strptime(net_cdf_date, '%Y-%m-%d') + dt.timedelta(hours=24)).strftime('%Y-%m-%d')
+
+
+def load_points(points_file):
+    return np.genfromtxt(points_file, delimiter=',')
+
+
+def get_points_area(points):
+    # lat_min, lat_max, lon_min, lon_max
+    return np.min(points, 0)[2], np.max(points, 0)[2], np.min(points, 0)[1], np.max(points, 0)[1]
+
+
+def get_output_path(output_dir, model, n_models):
+    if n_models == 1:
+        return os.path.join(output_dir, 'RAINCELL.DAT')
+    return os.path.join(output_dir, model, 'RAINCELL.DAT')
+
+
+def read_forecast(netcdf_file, models_points, obs_end, forecast_days):
+    # Reads the forecast window of the WRF run once, over the union of the areas of all models.
+    # Each model keeps the WRF bins of its own area (so that its points map to the same cells as in a single model
+    # run), plus the offsets of that area within the union, and its window : its area padded by one cell, within
+    # which its forecast is interpolated whatever the other models (see interpolation.get_forecast_weights)
+    with netcdf_reader.WrfRfReader(netcdf_file) as rf_reader:
+        model_slices = {m: rf_reader.get_area_slices(*get_points_area(p)) for m, p in models_points.items()}
+        n_lats, n_lons = len(rf_reader.lats), len(rf_reader.lons)
+        window_slices = {m: (slice(max(s[0].start - 1, 0), min(s[0].stop + 1, n_lats)),
+                             slice(max(s[1].start - 1, 0), min(s[1].stop + 1, n_lons)))
+                         for m, s in model_slices.items()}
+        lat_slice = slice(min(s[0].start for s in window_slices.values()),
+                          max(s[0].stop for s in window_slices.values()))
+        lon_slice = slice(min(s[1].start for s in window_slices.values()),
+                          max(s[1].stop for s in window_slices.values()))
+        rf_reader.set_slices(lat_slice, lon_slice)
+
+        times = rf_reader.times
+        t0 = dt.datetime.strptime(times[0], '%Y-%m-%d_%H:%M:%S')
+        t1 = dt.datetime.strptime(times[1], '%Y-%m-%d_%H:%M:%S')
+        res_mins = int((t1 - t0).total_seconds() / 60)
+
+        forecast_start_idx = rf_reader.get_time_idx(
+            utils.datetime_lk_to_utc(obs_end, shift_mins=30).strftime('%Y-%m-%d_%H:%M:%S'))
+        forecast_steps = int(24 * 60 * forecast_days / res_mins) - 1
+        diff = rf_reader.read_diff(forecast_start_idx + 1, forecast_start_idx + 1 + forecast_steps)
+
+        areas = {}
+        for m, (m_lat_slice, m_lon_slice) in model_slices.items():
+            lats, lons = rf_reader.get_axes(m_lat_slice, m_lon_slice)
+            areas[m] = {
+                'lat_bins': grid_mapping.get_bins(lats),
+                'lon_bins': grid_mapping.get_bins(lons),
+                'row_offset': m_lat_slice.start - lat_slice.start,
+                'col_offset': m_lon_slice.start - lon_slice.start,
+                'window': tuple(slice(w.start - u.start, w.stop - u.start)
+                                for w, u in zip(window_slices[m], (lat_slice, lon_slice))),
+            }
+
+        # cell centre axes of the union window, for the interpolation of the forecast
+        lats, lons = np.asarray(rf_reader.lats), np.asarray(rf_reader.lons)
+
+    return {
+        'res_mins': res_mins,
+        'forecast_start_idx': forecast_start_idx,
+        'forecast_steps': forecast_steps,
+        'diff': diff,
+        'lats': lats,
+        'lons': lons,
+        'areas': areas,
+    }
+
+
+def start_stage(func, *args, **kwargs):
+    # runs func on a daemon thread, returning its Future. Being a daemon, a stage which never returns (e.g. a hung
+    # MySQL query) is left behind after its timeout instead of keeping the process alive
+    future = Future()
+
+    def _run():
+        if not future.set_running_or_notify_cancel():
+            return
+        try:
+            future.set_result(func(*args, **kwargs))
+        except BaseException as e:
+            future.set_exception(e)
+
+    threading.Thread(target=_run, daemon=True).start()
+    return future
+
+
+def wait_stage(stage, future, timeouts, started=None):
+    # the timeout of a stage runs from started (time.monotonic() when it was started), not from the wait, so that
+    # stages waited on one after the other do not add up their timeouts
+    timeout = timeouts.get(stage)
+    remaining = timeout
+    if timeout is not None and started is not None:
+        remaining = max(timeout - (time.monotonic() - started), 0)
+    try:
+        return future.result(timeout=remaining)
+    except FutureTimeoutError:
+        raise TimeoutError('%s did not finish within %s seconds' % (stage, timeout))
+
+
+def write_model_raincell(job):
+    # Maps the points of one model to the WRF cells and thiessen polygons and writes its RAINCELL.DAT.
+    # Runs in a worker process; job is a plain dict so that it pickles.
+    points_file = job['points_file']
+    points = job['points'] if job['points'] is not None else load_points(points_file)
+    area = job['area']
+    refresh = job['refresh_mappings']
+
+    # the worker keeps its own metrics, which are merged by generate_raincells
+    job_metrics = metrics.Metrics() if job['metrics'] else metrics.NULL_METRICS
+
+    with job_metrics.timer('wrf_mapping'):
+        rf_y, rf_x = mapping_cache.get_wrf_mapping(job['mapping_cache_dir'], points_file, points, area['lat_bins'],
+                                                   area['lon_bins'], refresh=refresh)
+    with job_metrics.timer('thiessen_mapping'):
+        point_thess_idx, station_ids = mapping_cache.get_thiessen_mapping(job['mapping_cache_dir'], points_file,
+                                                                          points, job['obs_stations'],
+                                                                          job['shp_file'], lambda: job['thess_poly'],
+                                                                          refresh=refresh)
+    job_metrics.count('points', len(points))
+    if job['obs'] is None:
+        return job['model'], None, 0, job_metrics.to_dict(), None
+
+    output_file_path = job['output_file_path']
+    if not os.path.exists(os.path.dirname(output_file_path)):
+        os.makedirs(os.path.dirname(output_file_path))
+
+    forecast = job['forecast']
+    obs_scheme, forecast_scheme = job['interpolation']
+    with job_metrics.timer('interpolation_weights'):
+        obs_weights = interpolation.get_obs_weights(obs_scheme, points, point_thess_idx, station_ids,
+                                                    job['obs_stations'])
+        forecast_weights = interpolation.get_forecast_weights(forecast_scheme, points, rf_y + area['row_offset'],
+                                                              rf_x + area['col_offset'], forecast['lats'],
+                                                              forecast['lons'], window=area['window'])
+    # the (time, point) rainfall is streamed to the file in chunks of time steps, which bounds the memory of the
+    # large grids to memory_limit_mb
+    chunk_steps = interpolation.get_chunk_steps(len(points), max(job['obs_steps'], forecast['forecast_steps']),
+                                                job['memory_limit_mb'])
+    rainfall = interpolation.SectionedRainfall(
+        (obs_weights, interpolation.get_observed_source(job['obs'], station_ids, job['obs_steps'])),
+        (forecast_weights, interpolation.get_forecast_source(forecast['diff'], forecast['forecast_start_idx'],
+                                                             forecast['forecast_steps'],
+                                                             diff_offset=forecast['forecast_start_idx'] + 1)))
+
+    # in the incremental mode, the time steps which did not change since the last run of the model are copied from
+    # its RAINCELL.DAT, see incremental
+    state_path = job['incremental_path']
+    keys = None
+    state = None
+    if state_path is not None:
+        run_key = incremental.get_run_key(points_file, job['obs_stations'], job['shp_file'], job['interpolation'],
+                                          job['header'][0], job['forecast_source'], qc_key=job['qc_key'])
+        keys = incremental.get_obs_keys(job['obs'], job['obs_steps']) + \
+            incremental.get_forecast_keys(job['netcdf_file'], forecast['forecast_start_idx'],
+                                          forecast['forecast_steps'])
+        state = None if job['force_full'] else incremental.load_state(state_path, run_key)
+    plan = incremental.get_plan(keys or range(len(rainfall)), state)
+
+    # written to the staging directory first (next to the output without one), as the previous file may be the
+    # output itself, then published in place with its checksum and optional compressed copy, see staging
+    staging_path = staging.get_staging_path(output_file_path, job['staging_dir'])
+    try:
+        started = time.perf_counter()
+        with job_metrics.timer('write'), raincell_writer.open_raincell(staging_path) as output_file:
+            writer = raincell_writer.RaincellWriter(output_file, points[:, 0], chunk_steps=min(chunk_steps, 24))
+            writer.write_header(*job['header'])
+            header_size = writer.size
+            incremental.write_steps(writer, rainfall, plan, state[0] if state is not None else None, chunk_steps)
+        write_seconds = time.perf_counter() - started
+        with job_metrics.timer('publish'):
+            manifest_entry = staging.publish(staging_path, output_file_path, compression=job['compression'])
+    finally:
+        if os.path.exists(staging_path):
+            os.remove(staging_path)
+    manifest_entry['model'] = job['model']
+    manifest_entry['write_seconds'] = round(write_seconds, 3)
+    if state_path is not None:
+        incremental.save_state(state_path, run_key, output_file_path, keys, header_size, writer.step_sizes)
+        job_metrics.count('steps_copied', sum(len(copy[1]) for start, end, copy in plan if copy is not None))
+    job_metrics.count('lines_written', writer.lines_written)
+    job_metrics.count('bytes_written', os.path.getsize(output_file_path))
+    return job['model'], output_file_path, writer.lines_written, job_metrics.to_dict(), manifest_entry
+
+
+def generate_raincells(netcdf_file, start_ts_lk, duration_days, obs_stations, models_points, shp_file, adapter,
+                       output_dir, mapping_cache_dir=None, refresh_mappings=False, prebuild_mappings=False,
+                       forecast_source='wrf0', max_workers=None, points=None, obs=None,
+                       interpolation_schemes=('thiessen', 'nearest'), memory_limit_mb=None, timeouts=None,
+                       catchment_files=None, incremental_dir=None, force_full=False, staging_dir=None,
+                       compression=None, qc=None):
+    # Writes a RAINCELL.DAT for every model of models_points ({model: points file}) from a single NetCDF read, a
+    # single observation fetch and a single tessellation. The per model mapping and writing run in worker processes,
+    # unless max_workers is 1.
+    # Already loaded points ({model: array}) and observations (see observations.get_observed_precip) can be given,
+    # in which case adapter is not used.
+    # interpolation_schemes : (observed, forecast) schemes, see interpolation.OBS_SCHEMES and FORECAST_SCHEMES
+    # memory_limit_mb : memory ceiling of the rainfall chunks of each model while it is written, None for no limit
+    # The NetCDF read, the tessellation and the observation fetch do not depend on each other and run concurrently,
+    # each within its timeout (see STAGE_TIMEOUTS, overridden by timeouts). The models are only written once all
+    # of them are done.
+    # catchment_files : shape files and points files of catchments (see catchments.load_catchments), whose mean
+    # rainfall series are written to output_dir/CATCHMENT_RAIN.csv, and their coverage to CATCHMENT_RAIN_COVERAGE.csv
+    # incremental_dir : directory of the incremental state of the models (see incremental), whose unchanged time
+    # steps are then copied from their last RAINCELL.DAT, unless force_full
+    # staging_dir : local directory the files are written to before they are moved in place (e.g. off the NFS mount),
+    # None writes them next to the output. compression : None, or 'gzip' or 'zstd' for a compressed copy of each
+    # file (see staging.COMPRESSIONS). The files, their checksums and timings are listed in output_dir/MANIFEST.json
+    # qc : qc.StationQC of the fetched observations, whose report is written to output_dir/QC_REPORT.json once the
+    # models are written
+    if interpolation_schemes[0] not in interpolation.OBS_SCHEMES or \
+            interpolation_schemes[1] not in interpolation.FORECAST_SCHEMES:
+        raise ValueError('Unknown interpolation schemes %s' % (interpolation_schemes,))
+    staging.check_compression(compression)
+    if points is None:
+        points = {m: load_points(f) for m, f in models_points.items()}
+    catchment_gdf = None
+    if catchment_files and not prebuild_mappings:
+        catchment_gdf = catchments.load_catchments(catchment_files, netcdf_file=netcdf_file)
+
+    obs_start = dt.datetime.strptime(start_ts_lk, '%Y-%m-%d_%H:%M') - dt.timedelta(days=duration_days[0])
+    obs_end = dt.datetime.strptime(start_ts_lk, '%Y-%m-%d_%H:%M')
+    forecast_end = dt.datetime.strptime(start_ts_lk, '%Y-%m-%d_%H:%M') + dt.timedelta(days=duration_days[1])
+    print([obs_start, obs_end, forecast_end])
+
+    timeouts = dict(STAGE_TIMEOUTS, **(timeouts or {}))
+    run_metrics = metrics.get_metrics()
+
+    def _read_forecast():
+        with run_metrics.timer('netcdf_read'):
+            # the window also covers the catchments, which are not models of their own
+            area_points = points if catchment_gdf is None else \
+                dict(points, **{'_catchments': catchments.get_extent_points(catchment_gdf)})
+            return read_forecast(netcdf_file, area_points, obs_end, duration_days[1])
+
+    def _all_thiessen_cached():
+        return all(mapping_cache.has_thiessen_mapping(mapping_cache_dir, models_points[m], points[m], obs_stations,
+                                                      shp_file) for m in points)
+
+    def _get_thess_poly():
+        # the voronoi polygons are only needed if a model misses its cached thiessen mapping (or for the catchments),
+        # and are themselves cached per station set
+        if catchment_gdf is None and not refresh_mappings and _all_thiessen_cached():
+            return None
+        with run_metrics.timer('voronoi'):
+            return mapping_cache.get_voronoi_polygons(
+                mapping_cache_dir, obs_stations, shp_file,
+                lambda: spatial_utils.get_voronoi_polygons(obs_stations, shp_file, add_total_area=False),
+                refresh=refresh_mappings)
+
+    started = time.monotonic()
+    forecast_future = start_stage(_read_forecast)
+    thess_poly_future = start_stage(_get_thess_poly)
+    obs_future = None
+    if prebuild_mappings:
+        obs = None
+    elif obs is None:
+        obs_future = start_stage(observations.get_observed_precip, obs_stations, obs_start, obs_end, duration_days,
+                                 adapter, forecast_source=forecast_source, qc=qc, return_report=True)
+
+    qc_report = None
+    try:
+        forecast = wait_stage('netcdf_read', forecast_future, timeouts, started)
+        thess_poly = wait_stage('voronoi', thess_poly_future, timeouts, started)
+        if obs_future is not None:
+            obs, qc_report = wait_stage('obs_fetch', obs_future, timeouts, started)
+    except BaseException:
+        # the run is given up, while the requests of the fetch (timed out, or still running after another stage
+        # failed) may hold their connections forever, the next run gets new ones
+        if obs_future is not None and isinstance(adapter, observations.AdapterPool):
+            adapter.abandon_held()
+        raise
+    res_mins = forecast['res_mins']
+
+    data_hours = int(sum(duration_days) * 24 * 60 / res_mins)
+    header = (res_mins, data_hours, obs_start.strftime('%Y-%m-%d %H:%M:%S'), forecast_end.strftime('%Y-%m-%d %H:%M:%S'))
+    jobs = [{
+        'model': m,
+        'points_file': models_points[m],
+        # only passed on when the jobs run in this process, the worker processes load the points themselves
+        'points': points[m] if len(models_points) == 1 or max_workers == 1 else None,
+        'output_file_path': get_output_path(output_dir, m, len(models_points)),
+        'area': forecast['areas'][m],
+        'forecast': {k: forecast[k] for k in ('diff', 'forecast_start_idx', 'forecast_steps', 'lats', 'lons')},
+        'obs': obs,
+        'obs_steps': int(24 * 60 * duration_days[0] / res_mins) + 1,
+        'header': header,
+        'obs_stations': obs_stations,
+        'shp_file': shp_file,
+        'thess_poly': thess_poly,
+        'mapping_cache_dir': mapping_cache_dir,
+        'refresh_mappings': refresh_mappings,
+        'interpolation': interpolation_schemes,
+        'memory_limit_mb': memory_limit_mb,
+        'netcdf_file': netcdf_file,
+        'forecast_source': forecast_source,
+        'incremental_path': os.path.join(incremental_dir, '%s_%s.npz' % (forecast_source, m))
+        if incremental_dir is not None else None,
+        'force_full': force_full,
+        'staging_dir': staging_dir,
+        'compression': compression,
+        'qc_key': qc.get_key() if qc is not None else None,
+        'metrics': run_metrics.enabled,
+    } for m in models_points]
+
+    if len(jobs) == 1 or max_workers == 1:
+        results = [write_model_raincell(job) for job in jobs]
+    else:
+        with ProcessPoolExecutor(max_workers=max_workers or len(jobs)) as executor:
+            results = list(executor.map(write_model_raincell, jobs))
+
+    for model, output_file_path, lines, job_metrics, manifest_entry in results:
+        run_metrics.merge(job_metrics, prefix=model + '.')
+        print('generate_raincells|%s : %s (%d lines)' % (model, output_file_path, lines))
+
+    if catchment_gdf is not None:
+        catchment_file = os.path.join(output_dir, 'CATCHMENT_RAIN.csv')
+        with run_metrics.timer('catchments'):
+            catchment_rf, coverage = catchments.get_catchment_rf(catchment_gdf, forecast, obs, thess_poly, obs_start,
+                                                                 int(24 * 60 * duration_days[0] / res_mins) + 1)
+            if not os.path.exists(output_dir):
+                os.makedirs(output_dir)
+            catchments.write_catchment_rf(catchment_rf, catchment_file, coverage=coverage)
+        print('generate_raincells|%d catchments : %s' % (catchment_rf.shape[1], catchment_file))
+
+    manifest_entries = [r[4] for r in results if r[4] is not None]
+    if manifest_entries:
+        staging.write_manifest(output_dir, manifest_entries, netcdf_file=netcdf_file, start_ts_lk=start_ts_lk,
+                               forecast_source=forecast_source)
+    # only once the models are in place, so that a failed run does not leave an output_dir behind
+    if qc_report is not None:
+        staging.write_json(os.path.join(output_dir, QC_REPORT_FILE), qc_report)
+    return results
@@ -0,0 +1,122 @@
+import hashlib
+import json
+import threading
+import numpy as np
+
+# Quality control of the hourly observed series of the stations (see observations.get_observed_precip), as array
+# operations on the whole (hour, station) block at once. The flagged hours are blanked, so that they are filled from
+# the `Forecast-0-d` series of their station like the missing ones.
+#  - range : outside the min_values / max_values of the station variable in StationConfig.json
+#  - spike : more than SPIKE_MM above both neighbouring hours (a single faulty reading)
+#  - flatline : the same non-zero value for FLATLINE_HOURS hours or more (a stuck gauge)
+CHECKS = ('range', 'spike', 'flatline')
+SPIKE_MM = 50.0
+FLATLINE_HOURS = 6
+
+
+class StationRegistry:
+    # min / max values of the variables of the stations of a StationConfig.json, indexed by the station name and id
+    def __init__(self, station_config):
+        # digest of the limits, see StationQC.get_key
+        self.digest = hashlib.sha1(json.dumps(station_config, sort_keys=True).encode('utf-8')).hexdigest()
+        self.limits = {}
+        for station in station_config['stations']:
+            limits = {v: (float(lo), float(hi)) for v, lo, hi in
+                      zip(station['variables'], station['min_values'], station['max_values'])}
+            self.limits[station['name']] = limits
+            self.limits[station['stationId']] = limits
+
+    @classmethod
+    def load(cls, path):
+        with open(path) as f:
+            return cls(json.load(f))
+
+    def get_limits(self, stations, variable='Precipitation'):
+        # (min, max) arrays in the order of stations, NaN for the stations (or variables) without limits
+        limits = np.array([self.limits.get(s, {}).get(variable, (np.nan, np.nan)) for s in stations], dtype=float)
+        return limits.reshape(-1, 2)[:, 0], limits.reshape(-1, 2)[:, 1]
+
+    def __contains__(self, station):
+        return station in self.limits
+
+
+_registries = {}
+_registries_lock = threading.Lock()
+
+
+def get_registry(path):
+    # the StationRegistry of a StationConfig.json, loaded once per process
+    with _registries_lock:
+        if path not in _registries:
+            _registries[path] = StationRegistry.load(path)
+        return _registries[path]
+
+
+def range_flags(x, lo, hi):
+    with np.errstate(invalid='ignore'):
+        return (x < lo[None, :]) | (x > hi[None, :])
+
+
+def spike_flags(x, spike_mm=SPIKE_MM):
+    # the first and last hours are compared to their single neighbour
+    padded = np.pad(x, ((1, 1), (0, 0)), constant_values=np.nan)
+    neighbours = np.fmax(padded[:-2], padded[2:])
+    with np.errstate(invalid='ignore'):
+        return x - neighbours > spike_mm
+
+
+def flatline_flags(x, flatline_hours=FLATLINE_HOURS):
+    # runs of consecutive equal non-zero values of each column, all the hours of the runs of flatline_hours or more
+    n = len(x)
+    if n == 0:
+        return np.zeros(x.shape, dtype=bool)
+    hours = np.arange(n)[:, None]
+    with np.errstate(invalid='ignore'):
+        same = np.zeros(x.shape, dtype=bool)
+        same[1:] = (x[1:] == x[:-1]) & (x[1:] > 0)
+    # first and last hour of the run of each hour
+    start = np.maximum.accumulate(np.where(same, 0, hours), axis=0)
+    continued = np.zeros(x.shape, dtype=bool)
+    continued[:-1] = same[1:]
+    end = np.minimum.accumulate(np.where(continued, n, hours)[::-1], axis=0)[::-1]
+    return end - start + 1 >= flatline_hours
+
+
+class StationQC:
+    # range, spike and flatline checks of the observed `variable` of the stations, see the checks above
+    def __init__(self, registry, variable='Precipitation', spike_mm=SPIKE_MM, flatline_hours=FLATLINE_HOURS):
+        self.registry = registry
+        self.variable = variable
+        self.spike_mm = spike_mm
+        self.flatline_hours = flatline_hours
+
+    def get_key(self):
+        # everything which changes the checked observations, e.g. for incremental.get_run_key
+        return '%s|%s|%s|%s' % (self.registry.digest, self.variable, self.spike_mm, self.flatline_hours)
+
+    def check(self, obs):
+        # {check: (hour, station) bool array} of the obs DataFrame (hourly rows by station)
+        x = obs.values.astype(float)
+        lo, hi = self.registry.get_limits(list(obs.columns), self.variable)
+        return {
+            'range': range_flags(x, lo, hi),
+            'spike': spike_flags(x, self.spike_mm),
+            'flatline': flatline_flags(x, self.flatline_hours),
+        }
+
+    def apply(self, obs):
+        # (obs with the flagged hours set to NaN, report of the flagged hours of each station)
+        flags = self.check(obs)
+        flagged = np.logical_or.reduce([flags[c] for c in CHECKS])
+        report = {
+            'checks': {'variable': self.variable, 'spike_mm': self.spike_mm, 'flatline_hours': self.flatline_hours},
+            'hours': len(obs),
+            'flagged': int(flagged.sum()),
+            'unknown_stations': [s for s in obs.columns if s not in self.registry],
+            'stations': {},
+        }
+        for j in np.flatnonzero(flagged.any(axis=0)):
+            report['stations'][obs.columns[j]] = dict(
+                {c: int(flags[c][:, j].sum()) for c in CHECKS},
+                hours=[t.strftime('%Y-%m-%d %H:%M:%S') for t in obs.index[flagged[:, j]]])
+        return obs.mask(flagged), report
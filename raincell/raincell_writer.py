@@ -0,0 +1,50 @@
+import numpy as np
+
+BUFFER_SIZE = 4 * 1024 * 1024
+
+
+def open_raincell(path, buffering=BUFFER_SIZE):
+    return open(path, 'w', buffering=buffering)
+
+
+class RaincellWriter:
+    # Writes RAINCELL.DAT rows a whole time step at a time. `backend` is anything with a write(str) method
+    # (a plain file from open_raincell, a gzip stream, an in-memory buffer ...)
+    def __init__(self, backend, point_ids, chunk_steps=24):
+        self.backend = backend
+        self.chunk_steps = chunk_steps
+        self.n_points = len(point_ids)
+        # one '%d %.1f\n' line per point with the id already filled in, so that a whole time step is formatted
+        # by a single % operation
+        self.step_fmt = ''.join('%d %%.1f\n' % pid for pid in point_ids)
+        self.lines_written = 0
+        # characters (= bytes, the lines are ASCII) written so far, and the size of each time step written
+        self.size = 0
+        self.step_sizes = []
+
+    def write_header(self, res_mins, data_hours, start_ts, end_ts):
+        header = "%d %d %s %s\n" % (res_mins, data_hours, start_ts, end_ts)
+        self.backend.write(header)
+        self.size += len(header)
+
+    def write_steps(self, rf):
+        # rf : (time, point) rainfall array
+        rf = np.asarray(rf, dtype=float)
+        if rf.ndim != 2 or rf.shape[1] != self.n_points:
+            raise ValueError('Expected a (time, %d) rainfall array, got %s' % (self.n_points, rf.shape))
+
+        for i in range(0, len(rf), self.chunk_steps):
+            chunk = rf[i:i + self.chunk_steps].tolist()
+            steps = [self.step_fmt % tuple(row) for row in chunk]
+            self.backend.write(''.join(steps))
+            self._add_steps([len(step) for step in steps])
+
+    def write_formatted_steps(self, text, step_sizes):
+        # time steps already formatted by a RaincellWriter of the same points, e.g. copied from a previous file
+        self.backend.write(text)
+        self._add_steps(step_sizes)
+
+    def _add_steps(self, step_sizes):
+        self.step_sizes.extend(step_sizes)
+        self.size += sum(step_sizes)
+        self.lines_written += len(step_sizes) * self.n_points
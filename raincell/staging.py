@@ -0,0 +1,165 @@
+import datetime as dt
+import gzip
+import hashlib
+import json
+import os
+import queue
+import threading
+import time
+from contextlib import contextmanager, nullcontext
+
+# Output staging of the RAINCELL.DAT files. A file is written to a local staging directory (instead of with many
+# small writes to the NFS mount), then copied next to its destination in large blocks and moved into place with
+# os.replace, so that the FLO-2D jobs never pick up a half written file. A compressed copy can be written alongside,
+# from the same blocks and in parallel with the copy.
+
+BLOCK_SIZE = 8 * 1024 * 1024
+COMPRESSIONS = {
+    'gzip': '.gz',
+    'zstd': '.zst',
+}
+MANIFEST_FILE = 'MANIFEST.json'
+
+
+def get_tmp_path(path):
+    # tmp file of this process next to path, which is then moved into place with os.replace
+    return '%s.%d.tmp' % (path, os.getpid())
+
+
+@contextmanager
+def atomic_write(path, mode='w'):
+    # file to write path with, through a tmp file and os.replace so that a reader never sees a partial file. The tmp
+    # file is removed if the write fails, leaving any previous path as it was
+    tmp_path = get_tmp_path(path)
+    try:
+        with open(tmp_path, mode) as f:
+            yield f
+        os.replace(tmp_path, path)
+    finally:
+        if os.path.exists(tmp_path):
+            os.remove(tmp_path)
+
+
+def get_staging_path(output_file_path, staging_dir=None):
+    # local path to write output_file_path to. Without a staging_dir, the file is written next to its destination
+    if staging_dir is None:
+        return get_tmp_path(output_file_path)
+    if not os.path.exists(staging_dir):
+        os.makedirs(staging_dir, exist_ok=True)
+    name = os.path.abspath(output_file_path).strip(os.sep).replace(os.sep, '_')
+    return os.path.join(staging_dir, '%s.%d.tmp' % (name, os.getpid()))
+
+
+def check_compression(compression):
+    # raises ValueError if compression is not None and cannot be written here
+    if compression is None:
+        return
+    if compression not in COMPRESSIONS:
+        raise ValueError('Unknown compression %s, expected one of %s' % (compression, list(COMPRESSIONS.keys())))
+    if compression == 'zstd':
+        try:
+            import zstandard
+        except ImportError:
+            raise ValueError('zstd compression needs the zstandard package')
+
+
+def _open_compressed(path, compression):
+    if compression == 'gzip':
+        return gzip.open(path, 'wb', compresslevel=6)
+    elif compression == 'zstd':
+        try:
+            import zstandard
+        except ImportError:
+            raise ValueError('zstd compression needs the zstandard package')
+        return zstandard.ZstdCompressor(level=3).stream_writer(open(path, 'wb'), closefd=True)
+    raise ValueError('Unknown compression %s, expected one of %s' % (compression, list(COMPRESSIONS.keys())))
+
+
+def _compress(blocks, path, compression, errors):
+    # consumes the blocks of the queue until None, on its own thread (zlib and zstd release the GIL). On an error, the
+    # rest of the blocks are drained so that the copy does not block on a full queue
+    done = False
+    try:
+        with _open_compressed(path, compression) as f:
+            for block in iter(blocks.get, None):
+                f.write(block)
+            done = True
+    except Exception as e:
+        errors.append(e)
+        if not done:
+            for _ in iter(blocks.get, None):
+                pass
+
+
+def publish(staging_path, output_file_path, compression=None):
+    # moves the staged file to output_file_path (and its compressed copy next to it), returning its manifest entry
+    started = time.perf_counter()
+    sha256 = hashlib.sha256()
+    dest_tmp_path = get_tmp_path(output_file_path)
+    compressed_path = output_file_path + COMPRESSIONS[compression] if compression is not None else None
+    compressed_tmp_path = get_tmp_path(compressed_path) if compression is not None else None
+    in_place = os.path.abspath(staging_path) == os.path.abspath(dest_tmp_path)
+
+    blocks = queue.Queue(maxsize=4)
+    errors = []
+    compressor = None
+    if compression is not None:
+        compressor = threading.Thread(target=_compress, args=(blocks, compressed_tmp_path, compression, errors),
+                                      daemon=True)
+        compressor.start()
+
+    try:
+        # a file staged next to its destination is only read for its checksum and compressed copy
+        with open(staging_path, 'rb') as src, (nullcontext() if in_place else open(dest_tmp_path, 'wb')) as dest:
+            for block in iter(lambda: src.read(BLOCK_SIZE), b''):
+                sha256.update(block)
+                if dest is not None:
+                    dest.write(block)
+                if compressor is not None:
+                    blocks.put(block)
+        if compressor is not None:
+            blocks.put(None)
+            compressor.join()
+            compressor = None
+            if errors:
+                raise errors[0]
+            os.replace(compressed_tmp_path, compressed_path)
+        os.replace(dest_tmp_path, output_file_path)
+    finally:
+        if compressor is not None:
+            blocks.put(None)
+        for path in (staging_path, dest_tmp_path, compressed_tmp_path):
+            if path is not None and os.path.exists(path):
+                os.remove(path)
+
+    entry = {
+        'file': output_file_path,
+        'size': os.path.getsize(output_file_path),
+        'sha256': sha256.hexdigest(),
+        'publish_seconds': round(time.perf_counter() - started, 3),
+    }
+    if compressed_path is not None:
+        entry['compressed'] = {'file': compressed_path, 'size': os.path.getsize(compressed_path)}
+    return entry
+
+
+def write_manifest(output_dir, entries, **context):
+    # MANIFEST.json of the files of output_dir (see publish), written last and atomically so that it only lists
+    # complete files. The paths are relative to output_dir
+    files = []
+    for entry in entries:
+        entry = dict(entry, file=os.path.relpath(entry['file'], output_dir))
+        if 'compressed' in entry:
+            entry['compressed'] = dict(entry['compressed'],
+                                       file=os.path.relpath(entry['compressed']['file'], output_dir))
+        files.append(entry)
+    manifest = {'created': dt.datetime.now().strftime('%Y-%m-%d %H:%M:%S')}
+    manifest.update(context)
+    manifest['files'] = files
+    return write_json(os.path.join(output_dir, MANIFEST_FILE), manifest)
+
+
+def write_json(path, data):
+    with atomic_write(path) as f:
+        json.dump(data, f, indent=2)
+    return path
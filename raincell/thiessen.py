@@ -0,0 +1,24 @@
+import geopandas as gpd
+import numpy as np
+
+# polygon index of the points which are not inside any thiessen polygon
+OUTSIDE = -1
+
+
+def assign_points(points, thess_poly, polygon_attr='geometry'):
+    # Bulk version of spatial_utils.is_inside_geo_df over a whole points array ([id, lon, lat] rows).
+    # Returns the row index of the thess_poly polygon holding each point, or OUTSIDE
+    pts = gpd.GeoDataFrame(geometry=gpd.points_from_xy(points[:, 1], points[:, 2]), crs=thess_poly.crs)
+    polys = gpd.GeoDataFrame(geometry=np.asarray(thess_poly[polygon_attr]), crs=thess_poly.crs)
+    # sjoin queries the spatial index of the polygons instead of scanning them point by point
+    joined = gpd.sjoin(pts, polys, how='inner', predicate='within')
+
+    point_idx = np.full(len(points), OUTSIDE, dtype=np.int64)
+    # like is_inside_geo_df, the first matching polygon wins
+    first = joined['index_right'].groupby(level=0).min()
+    point_idx[first.index.values] = first.values
+    return point_idx
+
+
+def get_station_ids(thess_poly, id_attr='id'):
+    return list(thess_poly[id_attr])
@@ -0,0 +1,298 @@
+#!/usr/bin/python3
+import collections
+import glob
+import json
+import getopt
+import os
+import queue
+import sys
+import threading
+import time
+import traceback
+import datetime as dt
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+from urllib.parse import urlparse, parse_qs
+from curwmysqladapter import MySQLAdapter
+import obs_cache
+import observations
+import pipeline
+import qc
+
+
+def usage():
+    usage_text = """
+Usage: ./watch_raincell.py [-T wrf0,wrf1,...] [-t HH:MM:SS] [-i 60] [-p 8088] [-h]
+
+Runs as a service : watches NET_CDF_PATH for new WRF rf files and generates their RAINCELL.DAT as soon as they are
+complete, keeping the MySQL connections, the grid points and the settings loaded between the runs. Each run is
+written to WRF_DATA_DIR/<run date>_<run time>_<tag>. Runs can also be
+triggered over HTTP on localhost :
+    GET /run?date=YYYY-MM-DD[&time=HH:MM:SS][&tag=wrf0][&force=1]   Queue the run of a date
+    GET /status                                                     Queued and last runs
+
+-h  --help          Show usage
+-T  --tags          Comma separated tags of the simultaneous forecast runs E.g. wrf0,wrf1. Default wrf0. The tags
+                    other than wrf0 need a {tag} placeholder in the `NET_CDF_PATH` of CONFIG.json
+-t  --time          Run time of the new WRF rf files in HH:00:00. Default 00:00:00
+-f  --forward       Future day count. Default 3
+-b  --backward      Past day count. Default 2
+-M  --models        Comma separated FLO-2D models. Otherwise using the `FLO2D_MODEl` from CONFIG.json
+-i  --interval      Seconds between the scans of NET_CDF_PATH. Default 60
+-p  --port          Port of the HTTP trigger, 0 to disable it. Default 8088
+"""
+    print(usage_text)
+
+
+class RaincellService:
+    # Warm state of the watcher : the MySQL pool, the grid points of the models and the run settings. The runs found
+    # by scan() and the ones triggered over HTTP are queued, and generated one at a time by run_forever()
+    def __init__(self, net_cdf_path, wrf_data_dir, tags, run_time, duration_days, obs_stations, models_points,
+                 shp_file, adapter, mapping_cache_dir=None, memory_limit_mb=None, incremental_dir=None,
+                 staging_dir=None, compression=None, station_qc=None):
+        pipeline.check_tags(net_cdf_path, tags)
+        self.net_cdf_path = net_cdf_path
+        self.wrf_data_dir = wrf_data_dir
+        self.tags = tags
+        self.run_time = run_time
+        self.duration_days = duration_days
+        self.obs_stations = obs_stations
+        self.models_points = models_points
+        self.shp_file = shp_file
+        self.adapter = adapter
+        self.mapping_cache_dir = mapping_cache_dir
+        self.memory_limit_mb = memory_limit_mb
+        self.incremental_dir = incremental_dir
+        self.staging_dir = staging_dir
+        self.compression = compression
+        self.station_qc = station_qc
+        self.points = {m: pipeline.load_points(f) for m, f in models_points.items()}
+
+        self.queue = queue.Queue()
+        # rf file -> (size, mtime) when it was queued (or found on start up), and when it was last scanned
+        self.done = {}
+        self.scanned = {}
+        self.history = collections.deque(maxlen=100)
+        self.running = None
+
+    def get_run(self, run_date, run_time=None, tag='', netcdf_file=None, force=False):
+        run_time = run_time or self.run_time
+        tag = tag or self.tags[0]
+        return {
+            'name': '%s_%s_%s' % (tag, run_date, run_time),
+            'run_date': run_date,
+            'run_time': run_time,
+            'tag': tag,
+            'netcdf_file': netcdf_file or pipeline.get_netcdf_file(self.net_cdf_path, run_date, tag),
+            # one directory per tag, as the tags of a run date are watched together (same as batch_raincell.py)
+            'output_dir': os.path.join(self.wrf_data_dir, '%s_%s_%s' % (run_date, run_time, tag)),
+            'force': force,
+        }
+
+    def scan(self, initial=False):
+        # queues the runs of the rf files which showed up since the last scan, once their size and modification
+        # time are the same over two scans (i.e. the WRF run finished writing them). The files which are already
+        # there on start up are only recorded, those can be triggered over HTTP
+        for tag in self.tags:
+            for netcdf_file in sorted(glob.glob(pipeline.get_netcdf_glob(self.net_cdf_path, tag))):
+                try:
+                    stat = os.stat(netcdf_file)
+                except OSError:
+                    continue
+                state = (stat.st_size, stat.st_mtime)
+                if self.done.get(netcdf_file) == state:
+                    continue
+                if initial or self.scanned.get(netcdf_file) == state:
+                    self.done[netcdf_file] = state
+                    if not initial:
+                        run = self.get_run(pipeline.get_run_date(netcdf_file), tag=tag, netcdf_file=netcdf_file)
+                        print('watch_raincell|new WRF output %s' % netcdf_file)
+                        self.queue.put(run)
+                self.scanned[netcdf_file] = state
+
+    def generate(self, run):
+        started = dt.datetime.now()
+        self.running = run['name']
+        try:
+            if os.path.exists(run['output_dir']) and not run['force'] and self.incremental_dir is None:
+                status = {'status': 'skipped', 'error': '%s already exists' % run['output_dir']}
+            else:
+                start_ts_lk = dt.datetime.strptime('%s %s' % (run['run_date'], run['run_time']), '%Y-%m-%d %H:%M:%S')
+                results = pipeline.generate_raincells(run['netcdf_file'], start_ts_lk.strftime('%Y-%m-%d_%H:00'),
+                                                      self.duration_days, self.obs_stations, self.models_points,
+                                                      self.shp_file, self.adapter, run['output_dir'],
+                                                      mapping_cache_dir=self.mapping_cache_dir,
+                                                      forecast_source=run['tag'], points=self.points,
+                                                      memory_limit_mb=self.memory_limit_mb,
+                                                      incremental_dir=self.incremental_dir,
+                                                      force_full=run['force'],
+                                                      staging_dir=self.staging_dir,
+                                                      compression=self.compression, qc=self.station_qc)
+                status = {'status': 'success', 'outputs': [r[1] for r in results]}
+        except Exception as e:
+            status = {'status': 'failed', 'error': '%s: %s' % (type(e).__name__, e),
+                      'traceback': traceback.format_exc()}
+        finally:
+            self.running = None
+        status.update({'run': run['name'], 'started': started.strftime('%Y-%m-%d %H:%M:%S'),
+                       'seconds': (dt.datetime.now() - started).total_seconds()})
+        print('watch_raincell|%s %s %s' % (status['run'], status['status'], status.get('error', '')))
+        self.history.append(status)
+        return status
+
+    def get_status(self):
+        return {'queued': self.queue.qsize(), 'running': self.running, 'history': list(self.history)}
+
+    def run_forever(self, interval=60):
+        self.scan(initial=True)
+        print('watch_raincell|watching %d tag(s), %d existing WRF outputs' % (len(self.tags), len(self.done)))
+        next_scan = time.time() + interval
+        while True:
+            try:
+                run = self.queue.get(timeout=max(next_scan - time.time(), 0.1))
+                self.generate(run)
+            except queue.Empty:
+                pass
+            if time.time() >= next_scan:
+                try:
+                    self.scan()
+                except Exception as e:
+                    # e.g. NET_CDF_PATH is on a NFS mount which is unavailable for a while
+                    print('watch_raincell|scan failed %s' % e)
+                next_scan = time.time() + interval
+
+
+def get_trigger_handler(service):
+    class TriggerHandler(BaseHTTPRequestHandler):
+        def _reply(self, code, body):
+            data = json.dumps(body, indent=2).encode('utf-8')
+            self.send_response(code)
+            self.send_header('Content-Type', 'application/json')
+            self.send_header('Content-Length', str(len(data)))
+            self.end_headers()
+            self.wfile.write(data)
+
+        def do_GET(self):
+            url = urlparse(self.path)
+            params = {k: v[0] for k, v in parse_qs(url.query).items()}
+            if url.path == '/status':
+                self._reply(200, service.get_status())
+            elif url.path == '/run':
+                try:
+                    dt.datetime.strptime(params['date'], '%Y-%m-%d')
+                    if 'time' in params:
+                        dt.datetime.strptime(params['time'], '%H:%M:%S')
+                except (KeyError, ValueError):
+                    self._reply(400, {'error': 'Expected /run?date=YYYY-MM-DD[&time=HH:MM:SS][&tag=..][&force=1]'})
+                    return
+                # the tag names the rf file and the output directory, only the watched ones are accepted
+                if params.get('tag', '') not in [''] + service.tags:
+                    self._reply(400, {'error': 'Unknown tag %s, expected one of %s' % (params['tag'], service.tags)})
+                    return
+                run = service.get_run(params['date'], params.get('time'), params.get('tag', ''),
+                                      force=params.get('force') == '1')
+                service.queue.put(run)
+                self._reply(202, run)
+            else:
+                self._reply(404, {'error': 'Unknown path %s' % url.path})
+
+        do_POST = do_GET
+
+        def log_message(self, format, *args):
+            print('watch_raincell|http %s' % (format % args))
+
+    return TriggerHandler
+
+
+def start_trigger_server(service, port):
+    server = ThreadingHTTPServer(('127.0.0.1', port), get_trigger_handler(service))
+    threading.Thread(target=server.serve_forever, daemon=True).start()
+    print('watch_raincell|trigger listening on http://127.0.0.1:%d' % server.server_address[1])
+    return server
+
+
+if __name__ == '__main__':
+    tags = ['wrf0']
+    run_time = '00:00:00'
+    backward = 2
+    forward = 3
+    models = None
+    interval = 60
+    port = 8088
+    try:
+        opts, args = getopt.getopt(sys.argv[1:], "hT:t:f:b:M:i:p:", [
+            "help", "tags=", "time=", "forward=", "backward=", "models=", "interval=", "port="
+        ])
+    except getopt.GetoptError:
+        usage()
+        sys.exit(2)
+    for opt, arg in opts:
+        if opt in ("-h", "--help"):
+            usage()
+            sys.exit()
+        elif opt in ("-T", "--tags"):
+            tags = arg.split(',')
+        elif opt in ("-t", "--time"):
+            run_time = arg
+        elif opt in ("-f", "--forward"):
+            forward = arg
+        elif opt in ("-b", "--backward"):
+            backward = arg
+        elif opt in ("-M", "--models"):
+            models = arg.split(',')
+        elif opt in ("-i", "--interval"):
+            interval = int(arg)
+        elif opt in ("-p", "--port"):
+            port = int(arg)
+    duration_days = (int(backward), int(forward))
+
+    obs_stations = pipeline.OBS_STATIONS
+    with open('CONFIG.json') as json_file:
+        config_data = json.load(json_file)
+    MYSQL_HOST = config_data['MYSQL_HOST']
+    MYSQL_USER = config_data['MYSQL_USER']
+    MYSQL_DB = config_data['MYSQL_DB']
+    MYSQL_PASSWORD = config_data['MYSQL_PASSWORD']
+    WRF_DATA_DIR = config_data['WRF_DATA_DIR']
+    NET_CDF_PATH = config_data['NET_CDF_PATH']
+    # the service keeps reusing the mappings, so it always uses a cache
+    mapping_cache_dir = config_data.get('MAPPING_CACHE_DIR', os.path.join(WRF_DATA_DIR, 'mapping_cache'))
+    memory_limit_mb = config_data.get('MEMORY_LIMIT_MB')
+    if models is None:
+        models = config_data['FLO2D_MODEl'].split(',')
+    models_points = {m: os.path.join(WRF_DATA_DIR, pipeline.MODEL_POINTS.get(m, pipeline.MODEL_POINTS['250m']))
+                     for m in models}
+    kelani_lower_basin_shp = os.path.join(WRF_DATA_DIR, 'klb-wgs84/klb-wgs84.shp')
+
+    def _get_adapter():
+        adapter = MySQLAdapter(host=MYSQL_HOST, user=MYSQL_USER, password=MYSQL_PASSWORD, db=MYSQL_DB)
+        if cache is None:
+            return adapter
+        return obs_cache.CachedAdapter(adapter, cache, revision_hours=int(
+            config_data.get('OBS_CACHE_REVISION_HOURS', obs_cache.REVISION_HOURS)))
+
+    cache = None
+    if config_data.get('OBS_CACHE_DB') is not None:
+        cache = obs_cache.ObservationCache(config_data['OBS_CACHE_DB'],
+                                           max_days=max(duration_days[0] + 1,
+                                                        int(config_data.get('OBS_CACHE_DAYS', 5))))
+    # the connections are kept open between the runs, and reopened after being idle for MYSQL_MAX_IDLE seconds
+    adapter = observations.AdapterPool(_get_adapter, size=int(config_data.get('MYSQL_POOL_SIZE', 4)),
+                                       max_idle=int(config_data.get('MYSQL_MAX_IDLE', 3600)))
+
+    service = RaincellService(NET_CDF_PATH, WRF_DATA_DIR, tags, run_time, duration_days, obs_stations,
+                              models_points, kelani_lower_basin_shp, adapter, mapping_cache_dir=mapping_cache_dir,
+                              memory_limit_mb=int(memory_limit_mb) if memory_limit_mb is not None else None,
+                              incremental_dir=config_data.get('INCREMENTAL_DIR'),
+                              staging_dir=config_data.get('STAGING_DIR'),
+                              compression=config_data.get('OUTPUT_COMPRESSION'),
+                              station_qc=qc.StationQC(qc.get_registry(config_data['STATION_CONFIG']))
+                              if config_data.get('STATION_CONFIG') is not None else None)
+    server = start_trigger_server(service, port) if port else None
+    try:
+        service.run_forever(interval=interval)
+    except KeyboardInterrupt:
+        print('watch_raincell|stopping')
+    finally:
+        if server is not None:
+            server.shutdown()
+        adapter.close()
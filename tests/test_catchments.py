@@ -0,0 +1,27 @@
+import geopandas as gpd
+import numpy as np
+from shapely.geometry import box
+import catchments
+
+
+def _frame(geometries):
+    return gpd.GeoDataFrame({'id': ['c%d' % i for i in range(len(geometries))]}, geometry=geometries,
+                            crs='EPSG:4326')
+
+
+def test_area_weights_are_shares_of_the_covered_area():
+    # c0 : left half in the first polygon, quarter in the second, the rest outside. c1 : outside both
+    polygons = _frame([box(0, 0, 0.05, 0.1), box(0.05, 0, 0.075, 0.1)])
+    weights, coverage, is_polygon = catchments._area_weights(
+        _frame([box(0, 0, 0.1, 0.1), box(1, 1, 1.1, 1.1)]), polygons, np.arange(2))
+    np.testing.assert_allclose(weights.toarray(), [[2 / 3.0, 1 / 3.0], [0, 0]], rtol=1e-3)
+    np.testing.assert_allclose(coverage, [0.75, 0], atol=1e-3)
+    assert is_polygon.all()
+
+
+def test_catchments_covered_less_than_min_coverage_are_nan():
+    weights, coverage, _ = catchments._area_weights(
+        _frame([box(0, 0, 0.1, 0.1), box(0, 0, 0.1, 0.4)]), _frame([box(0, 0, 0.1, 0.1)]), np.arange(1))
+    rf = catchments._interpolate_covered(weights, coverage, np.array([[2.0], [4.0]]), 0.5)
+    np.testing.assert_allclose(rf[:, 0], [2.0, 4.0])
+    assert np.isnan(rf[:, 1]).all()
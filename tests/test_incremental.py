@@ -0,0 +1,62 @@
+import numpy as np
+import pandas as pd
+import incremental
+
+
+def _state(steps):
+    # state of a previous file of the steps, [(key, size)] written one after the other after a 10 byte header
+    offsets = 10 + np.concatenate([[0], np.cumsum([size for _, size in steps])[:-1]])
+    return 'previous.DAT', {key: (int(offset), size) for (key, size), offset in zip(steps, offsets)}
+
+
+def test_plan_without_state_computes_everything():
+    assert incremental.get_plan(['a', 'b', 'c'], None) == [(0, 3, None)]
+
+
+def test_plan_of_an_unchanged_file_copies_it_whole():
+    state = _state([('a', 5), ('b', 6), ('c', 7)])
+    assert incremental.get_plan(['a', 'b', 'c'], state) == [(0, 3, (10, [5, 6, 7]))]
+
+
+def test_plan_of_a_shifted_window():
+    # the window moved by one step : the first step of the previous file is gone, the last one is new
+    state = _state([('a', 5), ('b', 6), ('c', 7)])
+    assert incremental.get_plan(['b', 'c', 'd'], state) == [(0, 2, (15, [6, 7])), (2, 3, None)]
+
+
+def test_plan_splits_the_copies_which_are_not_contiguous_in_the_previous_file():
+    state = _state([('a', 5), ('b', 6), ('c', 7)])
+    assert incremental.get_plan(['a', 'c', 'x', 'b'], state) == \
+        [(0, 1, (10, [5])), (1, 2, (21, [7])), (2, 3, None), (3, 4, (15, [6]))]
+
+
+def test_plan_of_empty_keys():
+    assert incremental.get_plan([], _state([('a', 5)])) == []
+
+
+def test_obs_keys_change_with_the_station_values_of_their_hour():
+    index = pd.date_range('2018-09-09 06:00', periods=4, freq='h')
+    obs = pd.DataFrame({'Malabe': [0.0, 1.0, 2.0, 3.0], 'IBATTARA2': [0.5, 0.5, 0.5, 0.5]}, index=index)
+    keys = incremental.get_obs_keys(obs, 3)
+    assert len(keys) == 3 and len(set(keys)) == 3
+
+    late = obs.copy()
+    late.iloc[1, 1] = 4.5
+    late_keys = incremental.get_obs_keys(late, 3)
+    assert [k == l for k, l in zip(keys, late_keys)] == [True, False, True]
+
+    plan = incremental.get_plan(late_keys, _state([(k, 8) for k in keys]))
+    assert plan == [(0, 1, (10, [8])), (1, 2, None), (2, 3, (26, [8]))]
+
+
+def test_saved_state_is_loaded_for_the_same_run_key(tmp_path):
+    raincell_file = tmp_path / 'RAINCELL.DAT'
+    raincell_file.write_bytes(b'header\n' + b'a' * 5 + b'b' * 6)
+    state_path = str(tmp_path / 'state' / 'wrf0_250m.npz')
+    incremental.save_state(state_path, 'run', str(raincell_file), ['a', 'b'], 7, [5, 6])
+
+    assert incremental.load_state(state_path, 'run') == (str(raincell_file), {'a': (7, 5), 'b': (12, 6)})
+    assert incremental.load_state(state_path, 'other run') is None
+    # nor once the previous file changed
+    raincell_file.write_bytes(b'header\n')
+    assert incremental.load_state(state_path, 'run') is None
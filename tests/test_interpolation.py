@@ -0,0 +1,61 @@
+import numpy as np
+from scipy import sparse
+import interpolation
+
+LATS = np.array([6.8, 6.9, 7.0])
+LONS = np.array([79.8, 79.9, 80.0, 80.1])
+
+
+def _points(lon_lats):
+    # [id, lon, lat] rows
+    return np.array([[i, lon, lat] for i, (lon, lat) in enumerate(lon_lats)], dtype=float)
+
+
+def test_idw_weights_sum_to_one_and_favour_the_nearest_station():
+    stations = [[79.9, 6.9], [80.0, 6.9], [80.0, 7.0]]
+    weights = interpolation.idw_weights(_points([(79.91, 6.9), (79.95, 6.95)]), stations).toarray()
+    np.testing.assert_allclose(weights.sum(axis=1), 1)
+    assert weights[0].argmax() == 0
+    # the second point is as far from the three stations (up to the cos(lat) scale of the longitudes)
+    np.testing.assert_allclose(weights[1], 1 / 3.0, atol=1e-3)
+
+
+def test_idw_weights_of_a_point_on_a_station():
+    weights = interpolation.idw_weights(_points([(80.0, 6.9)]), [[79.9, 6.9], [80.0, 6.9]]).toarray()
+    np.testing.assert_array_equal(weights, [[0, 1]])
+
+
+def test_idw_weights_of_the_nearest_stations_only():
+    stations = [[79.9, 6.9], [80.0, 6.9], [80.5, 7.5]]
+    weights = interpolation.idw_weights(_points([(79.92, 6.9)]), stations, max_stations=2).toarray()
+    assert weights[0, 2] == 0
+    np.testing.assert_allclose(weights.sum(), 1)
+    # inverse squared distances, 0.02 and 0.08 degrees of longitude
+    np.testing.assert_allclose(weights[0, 0] / weights[0, 1], (0.08 / 0.02) ** 2)
+
+
+def test_bilinear_weights_between_the_cell_centres():
+    weights = interpolation.bilinear_weights(_points([(79.85, 6.85), (79.9, 6.9)]), LATS, LONS).toarray()
+    np.testing.assert_allclose(weights.sum(axis=1), 1)
+    # midway between the 4 cells (0, 0), (0, 1), (1, 0), (1, 1) of the raveled (row, col) cells
+    np.testing.assert_allclose(weights[0, [0, 1, 4, 5]], 0.25)
+    # on the centre of the cell (1, 1)
+    np.testing.assert_allclose(weights[1, 5], 1)
+
+
+def test_bilinear_weights_beyond_the_outer_centres_take_the_edge_values():
+    weights = interpolation.bilinear_weights(_points([(80.2, 7.1), (79.7, 6.85)]), LATS, LONS).toarray()
+    np.testing.assert_allclose(weights[0, 11], 1)
+    np.testing.assert_allclose(weights[1, [0, 4]], 0.5)
+
+
+def test_bilinear_weights_within_a_window():
+    # a point past the last centre of the window is held at its edge, even though the lats x lons cells go further
+    points = _points([(80.05, 6.85)])
+    window = (slice(0, 2), slice(1, 3))
+    weights = interpolation.get_forecast_weights('bilinear', points, None, None, LATS, LONS, window=window)
+    assert weights.shape == (1, 12)
+    windowed = interpolation.bilinear_weights(points, LATS[:2], LONS[1:3]).toarray()
+    np.testing.assert_allclose(weights.toarray()[0, [1, 2, 5, 6]], windowed[0])
+    np.testing.assert_allclose(weights.toarray()[0, [2, 6]], 0.5)
+    assert sparse.issparse(weights)
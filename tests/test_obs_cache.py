@@ -0,0 +1,140 @@
+import datetime as dt
+import pytest
+import obs_cache
+
+T0 = dt.datetime(2018, 9, 9, 6, 0)
+METAS = {
+    'Observed': {'station': 'Malabe', 'variable': 'Precipitation', 'unit': 'mm', 'type': 'Observed',
+                 'source': 'WeatherStation', 'name': 'A&T Labs'},
+    'Forecast-0-d': {'station': 'wrf_79.957123_6.913757', 'variable': 'Precipitation', 'unit': 'mm',
+                     'type': 'Forecast-0-d', 'source': 'wrf0'},
+}
+
+
+def _hours(h):
+    return T0 + dt.timedelta(hours=h)
+
+
+def _opts(start_hour, end_hour):
+    return {'from': _hours(start_hour).strftime(obs_cache.TIME_FORMAT),
+            'to': _hours(end_hour).strftime(obs_cache.TIME_FORMAT)}
+
+
+class FakeAdapter:
+    # 15 minute readings of (hour + minute / 100) up to `available` hours from T0, recording the requested windows
+    def __init__(self, available=1000):
+        self.available = available
+        self.requests = []
+
+    def retrieve_timeseries(self, meta, opts):
+        start = dt.datetime.strptime(opts['from'], obs_cache.TIME_FORMAT)
+        end = min(dt.datetime.strptime(opts['to'], obs_cache.TIME_FORMAT), _hours(self.available))
+        self.requests.append((meta['type'], opts['from'], opts['to']))
+        readings = []
+        t = start
+        while t <= end:
+            readings.append([t, (t - T0) // dt.timedelta(hours=1) + t.minute / 100.0])
+            t += dt.timedelta(minutes=15)
+        return [{'timeseries': readings}] if readings else []
+
+    def close(self):
+        pass
+
+
+@pytest.fixture
+def cache(tmp_path):
+    cache = obs_cache.ObservationCache(str(tmp_path / 'obs.sqlite'), max_days=2)
+    yield cache
+    cache.close()
+
+
+def _retrieve(adapter, meta_type, start_hour, end_hour):
+    row_ts = adapter.retrieve_timeseries(METAS[meta_type], _opts(start_hour, end_hour))
+    return row_ts[0]['timeseries'] if row_ts else []
+
+
+def test_uncached_types_are_passed_through(cache):
+    fake = FakeAdapter()
+    adapter = obs_cache.CachedAdapter(fake, cache)
+    _retrieve(adapter, 'Forecast-0-d', 0, 2)
+    _retrieve(adapter, 'Forecast-0-d', 0, 2)
+    assert len(fake.requests) == 2
+    assert cache.get_coverage(cache.get_key(METAS['Forecast-0-d'])) is None
+
+
+def test_first_request_fetches_the_whole_window(cache):
+    fake = FakeAdapter()
+    adapter = obs_cache.CachedAdapter(fake, cache)
+    readings = _retrieve(adapter, 'Observed', 0, 2)
+    assert fake.requests == [('Observed',) + tuple(_opts(0, 2).values())]
+    assert readings == FakeAdapter().retrieve_timeseries(METAS['Observed'], _opts(0, 2))[0]['timeseries']
+    assert cache.get_coverage(cache.get_key(METAS['Observed'])) == (_hours(0), _hours(2))
+
+
+def test_covered_window_only_fetches_from_the_revision_hours(cache):
+    fake = FakeAdapter()
+    adapter = obs_cache.CachedAdapter(fake, cache, revision_hours=2)
+    _retrieve(adapter, 'Observed', 0, 6.5)
+    readings = _retrieve(adapter, 'Observed', 1, 8)
+    # the last 2 cached hours may still be revised, they are fetched again
+    assert fake.requests[-1] == ('Observed',) + tuple(_opts(5, 8).values())
+    assert readings == FakeAdapter().retrieve_timeseries(METAS['Observed'], _opts(1, 8))[0]['timeseries']
+    assert cache.get_coverage(cache.get_key(METAS['Observed'])) == (_hours(0), _hours(8))
+
+
+def test_late_readings_of_the_last_cached_hour_are_picked_up(cache):
+    # the readings after 02:15 come in after the first run
+    fake = FakeAdapter(available=2.25)
+    adapter = obs_cache.CachedAdapter(fake, cache, revision_hours=1)
+    assert _retrieve(adapter, 'Observed', 0, 2.75)[-1][0] == _hours(2.25)
+    fake.available = 1000
+    readings = _retrieve(adapter, 'Observed', 0, 2.75)
+    assert fake.requests[-1] == ('Observed',) + tuple(_opts(2, 2.75).values())
+    assert [t for t, _ in readings] == [_hours(h / 4.0) for h in range(12)]
+
+
+def test_late_readings_of_the_empty_hours_are_picked_up(cache):
+    # the readings after 05:00 come in after the first run, long before the revision hours of the second one
+    fake = FakeAdapter(available=5)
+    adapter = obs_cache.CachedAdapter(fake, cache, revision_hours=1)
+    assert _retrieve(adapter, 'Observed', 0, 10)[-1][0] == _hours(5)
+    fake.available = 1000
+    readings = _retrieve(adapter, 'Observed', 0, 12)
+    assert fake.requests[-1] == ('Observed',) + tuple(_opts(5, 12).values())
+    assert readings == FakeAdapter().retrieve_timeseries(METAS['Observed'], _opts(0, 12))[0]['timeseries']
+
+
+def test_window_starting_before_the_coverage_is_fetched_whole(cache):
+    fake = FakeAdapter()
+    adapter = obs_cache.CachedAdapter(fake, cache)
+    _retrieve(adapter, 'Observed', 10, 12)
+    _retrieve(adapter, 'Observed', 8, 11)
+    assert fake.requests[-1] == ('Observed',) + tuple(_opts(8, 11).values())
+    assert cache.get_coverage(cache.get_key(METAS['Observed'])) == (_hours(8), _hours(12))
+
+
+def test_window_after_the_coverage_resets_it(cache):
+    fake = FakeAdapter()
+    adapter = obs_cache.CachedAdapter(fake, cache)
+    _retrieve(adapter, 'Observed', 0, 2)
+    _retrieve(adapter, 'Observed', 5, 7)
+    assert fake.requests[-1] == ('Observed',) + tuple(_opts(5, 7).values())
+    assert cache.get_coverage(cache.get_key(METAS['Observed'])) == (_hours(5), _hours(7))
+
+
+def test_window_without_data_is_cached_as_empty(cache):
+    fake = FakeAdapter(available=-1)
+    adapter = obs_cache.CachedAdapter(fake, cache)
+    assert adapter.retrieve_timeseries(METAS['Observed'], _opts(0, 2)) == []
+    assert cache.get_coverage(cache.get_key(METAS['Observed'])) == (_hours(0), _hours(2))
+
+
+def test_old_readings_are_evicted(cache):
+    fake = FakeAdapter()
+    adapter = obs_cache.CachedAdapter(fake, cache)
+    _retrieve(adapter, 'Observed', 0, 24)
+    _retrieve(adapter, 'Observed', 24, 72)
+    key = cache.get_key(METAS['Observed'])
+    # max_days=2 before the newest hour
+    assert cache.get_coverage(key) == (_hours(24), _hours(72))
+    assert cache.get(key, _hours(0), _hours(23)) == []
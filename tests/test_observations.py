@@ -0,0 +1,96 @@
+import datetime as dt
+import numpy as np
+import pytest
+import observations
+
+START = dt.datetime(2018, 9, 9, 6, 0)
+END = START + dt.timedelta(days=1)
+OBS_STATIONS = {
+    'Malabe': [79.95738, 6.90396, 'A&T Labs', 'wrf_79.957123_6.913757'],
+    'IBATTARA2': [79.919, 6.908, 'CUrW IoT', 'wrf_79.902664_6.913757'],
+}
+
+
+def _readings(value, start=START, end=END, skip_hours=()):
+    # 15 minute readings of value from start to end, without those of skip_hours (hours from START)
+    readings = []
+    t = start
+    while t <= end:
+        if (t - START) // dt.timedelta(hours=1) not in skip_hours:
+            readings.append([t, value])
+        t += dt.timedelta(minutes=15)
+    return readings
+
+
+class FakeAdapter:
+    # serves the readings of series, {(station, type): readings}, an empty result for the others
+    def __init__(self, series):
+        self.series = series
+        self.requests = []
+
+    def retrieve_timeseries(self, meta, opts):
+        self.requests.append((meta['station'], meta['type']))
+        readings = self.series.get((meta['station'], meta['type']))
+        return [{'timeseries': readings}] if readings else []
+
+    def close(self):
+        pass
+
+
+def _get_observed_precip(series, obs_stations=OBS_STATIONS):
+    adapter = FakeAdapter(series)
+    return observations.get_observed_precip(obs_stations, START, END, (1, 1), adapter), adapter
+
+
+def test_complete_stations_are_not_filled():
+    obs, adapter = _get_observed_precip({('Malabe', 'Observed'): _readings(0.5),
+                                         ('IBATTARA2', 'Observed'): _readings(0.25)})
+    assert list(obs.columns) == ['Malabe', 'IBATTARA2']
+    assert len(obs) == 25
+    # the last hour only holds the reading at END
+    np.testing.assert_allclose(obs['Malabe'].values, [2.0] * 24 + [0.5])
+    np.testing.assert_allclose(obs['IBATTARA2'].values, [1.0] * 24 + [0.25])
+    assert all(t == 'Observed' for _, t in adapter.requests)
+
+
+def test_missing_hours_are_filled_from_the_forecast():
+    obs, adapter = _get_observed_precip({('Malabe', 'Observed'): _readings(0.5, skip_hours=(3, 4)),
+                                         ('IBATTARA2', 'Observed'): _readings(0.25),
+                                         ('wrf_79.957123_6.913757', 'Forecast-0-d'): _readings(0.1)})
+    malabe = obs['Malabe'].values
+    np.testing.assert_allclose(malabe[[3, 4]], [0.4, 0.4])
+    np.testing.assert_allclose(np.delete(malabe, [3, 4, 24]), 2.0)
+    assert ('wrf_79.957123_6.913757', 'Forecast-0-d') in adapter.requests
+    assert ('wrf_79.902664_6.913757', 'Forecast-0-d') not in adapter.requests
+
+
+def test_station_without_data_takes_the_forecast():
+    obs, _ = _get_observed_precip({('Malabe', 'Observed'): _readings(0.5),
+                                   ('wrf_79.902664_6.913757', 'Forecast-0-d'): _readings(0.1)})
+    np.testing.assert_allclose(obs['IBATTARA2'].values, [0.4] * 24 + [0.1])
+    assert not obs.isna().any().any()
+
+
+def test_incomplete_forecast_fallback_fails():
+    with pytest.raises(observations.CurwObservationException, match='IBATTARA2'):
+        _get_observed_precip({('Malabe', 'Observed'): _readings(0.5),
+                              ('IBATTARA2', 'Observed'): _readings(0.25, skip_hours=(10,)),
+                              ('wrf_79.902664_6.913757', 'Forecast-0-d'): _readings(0.1, skip_hours=(10,))})
+
+
+def test_qc_flagged_hours_are_filled_from_the_forecast():
+    class RejectHour:
+        # flags the hour 5 of every station
+        def apply(self, obs):
+            flagged = np.zeros(obs.shape, dtype=bool)
+            flagged[5] = True
+            return obs.mask(flagged), {'flagged': int(flagged.sum()), 'stations': {}}
+
+    adapter = FakeAdapter({('Malabe', 'Observed'): _readings(0.5),
+                           ('IBATTARA2', 'Observed'): _readings(0.25),
+                           ('wrf_79.957123_6.913757', 'Forecast-0-d'): _readings(0.1),
+                           ('wrf_79.902664_6.913757', 'Forecast-0-d'): _readings(0.2)})
+    obs, report = observations.get_observed_precip(OBS_STATIONS, START, END, (1, 1), adapter, qc=RejectHour(),
+                                                   return_report=True)
+    np.testing.assert_allclose(obs.iloc[5].values, [0.4, 0.8])
+    assert report['filled'] == {'Malabe': 1, 'IBATTARA2': 1}
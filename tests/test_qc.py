@@ -0,0 +1,64 @@
+import numpy as np
+import pandas as pd
+import qc
+
+STATION_CONFIG = {'stations': [
+    {'name': 'Malabe', 'stationId': 'malabe_id', 'variables': ['Precipitation', 'Temperature'],
+     'min_values': [0, -5], 'max_values': [100, 50]},
+]}
+
+
+def test_flatline_flags_every_hour_of_the_long_runs():
+    x = np.array([[0, 1], [2, 1], [2, 1], [2, 1], [2, 0], [3, 1], [0, 1]], dtype=float)
+    flags = qc.flatline_flags(x, flatline_hours=3)
+    np.testing.assert_array_equal(flags[:, 0], [False, True, True, True, True, False, False])
+    np.testing.assert_array_equal(flags[:, 1], [True, True, True, True, False, False, False])
+
+
+def test_flatline_flags_ignore_zeros_and_nan():
+    x = np.array([[0], [0], [0], [0], [np.nan], [np.nan], [np.nan], [np.nan]])
+    assert not qc.flatline_flags(x, flatline_hours=2).any()
+
+
+def test_flatline_flags_at_the_edges():
+    x = np.array([[1.5], [1.5], [0.5], [4.0], [4.0]])
+    np.testing.assert_array_equal(qc.flatline_flags(x, flatline_hours=2)[:, 0], [True, True, False, True, True])
+    assert qc.flatline_flags(np.zeros((0, 2)), flatline_hours=2).shape == (0, 2)
+
+
+def test_spike_flags_compare_to_both_neighbours():
+    x = np.array([[0, 60], [70, 0], [10, 0], [80, 5], [0, 60]], dtype=float)
+    flags = qc.spike_flags(x, spike_mm=50)
+    # 80 is more than 50 above its neighbours, 70 is not above 10 by more than 50
+    np.testing.assert_array_equal(flags[:, 0], [False, True, False, True, False])
+    # the first and last hours only have one neighbour
+    np.testing.assert_array_equal(flags[:, 1], [True, False, False, False, True])
+
+
+def test_spike_flags_skip_missing_neighbours():
+    x = np.array([[np.nan], [60], [np.nan], [np.nan]])
+    np.testing.assert_array_equal(qc.spike_flags(x, spike_mm=50)[:, 0], [False, False, False, False])
+    x = np.array([[0], [60], [np.nan]])
+    np.testing.assert_array_equal(qc.spike_flags(x, spike_mm=50)[:, 0], [False, True, False])
+
+
+def test_apply_blanks_the_flagged_hours():
+    registry = qc.StationRegistry(STATION_CONFIG)
+    index = pd.date_range('2018-09-09 06:00', periods=4, freq='h')
+    obs = pd.DataFrame({'Malabe': [1.0, 120.0, 2.0, 3.0], 'Kotikawatta': [0.0, 0.0, 0.0, 200.0]}, index=index)
+    checked, report = qc.StationQC(registry).apply(obs)
+    assert checked['Malabe'].isna().tolist() == [False, True, False, False]
+    # a station without limits is still checked for spikes
+    assert checked['Kotikawatta'].isna().tolist() == [False, False, False, True]
+    assert report['flagged'] == 2
+    assert report['unknown_stations'] == ['Kotikawatta']
+    assert report['stations']['Malabe']['range'] == 1
+    assert report['stations']['Malabe']['hours'] == ['2018-09-09 07:00:00']
+
+
+def test_get_key_changes_with_the_checks():
+    registry = qc.StationRegistry(STATION_CONFIG)
+    assert qc.StationQC(registry).get_key() == qc.StationQC(qc.StationRegistry(STATION_CONFIG)).get_key()
+    assert qc.StationQC(registry).get_key() != qc.StationQC(registry, spike_mm=20).get_key()
+    config = {'stations': [dict(STATION_CONFIG['stations'][0], max_values=[80, 50])]}
+    assert qc.StationQC(registry).get_key() != qc.StationQC(qc.StationRegistry(config)).get_key()
@@ -0,0 +1,166 @@
+import io
+import os
+import geopandas as gpd
+import numpy as np
+import numpy.ma as ma
+import pandas as pd
+import pytest
+from netCDF4 import Dataset
+from shapely.geometry import Point, box
+import grid_mapping
+import interpolation
+import netcdf_reader
+import raincell_writer
+import thiessen
+
+# The RAINCELL.DAT written by the sparse weights and RaincellWriter must stay byte identical to the one of the
+# original per point loop (kept commented out in generator.py), on the bundled d01 run and the 250m points.
+ROOT = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+NETCDF_FILE = os.path.join(ROOT, 'input', 'results_wrf0_2018-09-09_18_00_0000_wrf_wrfout_d01_2018-09-09_18_00_00_rf')
+POINTS = np.genfromtxt(os.path.join(ROOT, 'resources', 'local', 'kelani_basin_points_250m.txt'), delimiter=',')
+HEADER = (180, 40, '2018-09-08 18:00:00', '2018-09-13 18:00:00')
+OBS_STEPS = 25
+# runs past the end of the 24 time steps of the d01 file, whose steps are written as 0
+FORECAST_START_IDX = 2
+FORECAST_STEPS = 25
+
+
+def _baseline_forecast_area(netcdf_file, points):
+    # diff, lats and lons of the area of the points, as read by ext_utils.extract_area_rf_series
+    nc = Dataset(netcdf_file, 'r')
+    try:
+        lats = nc.variables['XLAT'][0, :, 0]
+        lons = nc.variables['XLONG'][0, 0, :]
+        lon_min_idx = np.argmax(lons >= np.min(points, 0)[1]) - 1
+        lat_min_idx = np.argmax(lats >= np.min(points, 0)[2]) - 1
+        lon_max_idx = np.argmax(lons >= np.max(points, 0)[1])
+        lat_max_idx = np.argmax(lats >= np.max(points, 0)[2])
+        prcp = nc.variables['RAINC'][:, lat_min_idx:lat_max_idx, lon_min_idx:lon_max_idx] + \
+            nc.variables['RAINNC'][:, lat_min_idx:lat_max_idx, lon_min_idx:lon_max_idx]
+        times = nc.variables['Times'][:]
+        return ma.diff(prcp, axis=0), lats[lat_min_idx:lat_max_idx], lons[lon_min_idx:lon_max_idx], len(times) - 1
+    finally:
+        nc.close()
+
+
+def _baseline_observed(points, obs, thess_poly):
+    # the observed steps of the per point loop, each point taking the station of the first polygon holding it
+    point_thess_idx = []
+    for point in points:
+        inside = [s for s, poly in zip(thess_poly['id'], thess_poly['geometry'])
+                  if Point(point[1], point[2]).within(poly)]
+        point_thess_idx.append(inside[0] if inside else None)
+    lines = []
+    for t in range(OBS_STEPS):
+        for i, point in enumerate(points):
+            rf = float(obs[point_thess_idx[i]].values[t]) if point_thess_idx[i] is not None else 0
+            lines.append('%d %.1f\n' % (point[0], rf))
+    return ''.join(lines)
+
+
+def _baseline_forecast(points):
+    # the forecast steps of the per point loop, each point taking its WRF cell
+    diff, kel_lats, kel_lons, n_times = _baseline_forecast_area(NETCDF_FILE, points)
+    lat_bins = grid_mapping.get_bins(kel_lats)
+    lon_bins = grid_mapping.get_bins(kel_lons)
+    lines = []
+    for t in range(FORECAST_STEPS):
+        for point in points:
+            rf_x = np.digitize(point[1], lon_bins)
+            rf_y = np.digitize(point[2], lat_bins)
+            if t + FORECAST_START_IDX + 1 < n_times:
+                lines.append('%d %.1f\n' % (point[0], diff[t + FORECAST_START_IDX + 1, rf_y, rf_x]))
+            else:
+                lines.append('%d %.1f\n' % (point[0], 0))
+    return ''.join(lines)
+
+
+def _thess_poly():
+    # three stations over strips of the basin, leaving its eastern end outside of every polygon
+    return gpd.GeoDataFrame({'id': ['Colombo', 'Malabe', 'Hanwella']},
+                            geometry=[box(79.80, 6.70, 79.92, 7.10), box(79.92, 6.70, 79.95, 7.10),
+                                      box(79.95, 6.70, 80.10, 7.10)], crs='EPSG:4326')
+
+
+def _obs():
+    # hourly readings of the stations, with 2 decimals so that the rounding to 1 decimal is exercised
+    rng = np.random.default_rng(7)
+    return pd.DataFrame(np.round(rng.gamma(0.4, 3, (OBS_STEPS, 3)), 2), columns=['Colombo', 'Malabe', 'Hanwella'],
+                        index=pd.date_range('2018-09-08 18:00', periods=OBS_STEPS, freq='h'))
+
+
+@pytest.fixture(scope='module')
+def baseline_observed():
+    return _baseline_observed(POINTS, _obs(), _thess_poly())
+
+
+@pytest.fixture(scope='module')
+def baseline_forecast():
+    return _baseline_forecast(POINTS)
+
+
+def _observed_section(points, obs, thess_poly):
+    station_ids = thiessen.get_station_ids(thess_poly)
+    weights = interpolation.thiessen_weights(thiessen.assign_points(points, thess_poly), len(station_ids))
+    return weights, interpolation.get_observed_source(obs, station_ids, OBS_STEPS)
+
+
+def _forecast_section(points):
+    # like pipeline.read_forecast, the window read is the area of the points padded by one cell
+    with netcdf_reader.WrfRfReader(NETCDF_FILE) as rf_reader:
+        lat_slice, lon_slice = rf_reader.get_area_slices(np.min(points, 0)[2], np.max(points, 0)[2],
+                                                         np.min(points, 0)[1], np.max(points, 0)[1])
+        rf_reader.set_slices(slice(lat_slice.start - 1, lat_slice.stop + 1),
+                             slice(lon_slice.start - 1, lon_slice.stop + 1))
+        lats, lons = rf_reader.get_axes(lat_slice, lon_slice)
+        diff = rf_reader.read_diff(FORECAST_START_IDX + 1, FORECAST_START_IDX + 1 + FORECAST_STEPS)
+        n_rows, n_cols = len(rf_reader.lats), len(rf_reader.lons)
+    rows, cols = grid_mapping.get_wrf_cell_idx(points, grid_mapping.get_bins(lats), grid_mapping.get_bins(lons))
+    weights = interpolation.nearest_cell_weights(rows + 1, cols + 1, n_rows, n_cols)
+    return weights, interpolation.get_forecast_source(diff, FORECAST_START_IDX, FORECAST_STEPS,
+                                                      diff_offset=FORECAST_START_IDX + 1)
+
+
+def _write(points, *sections, chunk_steps=24, header=None):
+    output = io.StringIO()
+    writer = raincell_writer.RaincellWriter(output, points[:, 0], chunk_steps=chunk_steps)
+    if header is not None:
+        writer.write_header(*header)
+    rainfall = interpolation.SectionedRainfall(*sections)
+    for rf in rainfall.iter_chunks(chunk_steps):
+        writer.write_steps(rf)
+    return output.getvalue(), writer
+
+
+def _assert_same_text(text, expected):
+    # reports the first differing line, instead of a diff of the whole files
+    if text != expected:
+        lines, expected_lines = text.splitlines(), expected.splitlines()
+        first = next((i for i, (a, b) in enumerate(zip(lines, expected_lines)) if a != b),
+                     min(len(lines), len(expected_lines)))
+        assert (first, lines[first:first + 1], len(lines)) == (first, expected_lines[first:first + 1],
+                                                                 len(expected_lines))
+
+
+def test_nearest_forecast_matches_the_per_point_loop(baseline_forecast):
+    text, writer = _write(POINTS, _forecast_section(POINTS))
+    _assert_same_text(text, baseline_forecast)
+    assert writer.lines_written == FORECAST_STEPS * len(POINTS)
+
+
+def test_thiessen_observed_matches_the_per_point_loop(baseline_observed):
+    thess_poly = _thess_poly()
+    text, writer = _write(POINTS, _observed_section(POINTS, _obs(), thess_poly))
+    _assert_same_text(text, baseline_observed)
+    # some of the points are outside of the polygons, and written as 0
+    assert (thiessen.assign_points(POINTS, thess_poly) == thiessen.OUTSIDE).any()
+
+
+def test_raincell_writer_matches_the_per_point_loop_whatever_the_chunks(baseline_observed, baseline_forecast):
+    expected = '%d %d %s %s\n' % HEADER + baseline_observed + baseline_forecast
+    sections = (_observed_section(POINTS, _obs(), _thess_poly()), _forecast_section(POINTS))
+    for chunk_steps in (1, 7, OBS_STEPS + FORECAST_STEPS):
+        text, writer = _write(POINTS, *sections, chunk_steps=chunk_steps, header=HEADER)
+        _assert_same_text(text, expected)
+        assert writer.size == len(expected.encode('ascii'))
+        assert len(writer.step_sizes) == OBS_STEPS + FORECAST_STEPS
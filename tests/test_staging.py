@@ -0,0 +1,99 @@
+import gzip
+import hashlib
+import json
+import os
+import pytest
+import staging
+
+CONTENT = b''.join(b'%d %.1f\n' % (i, i % 7 / 10.0) for i in range(20000))
+
+
+def _stage(tmp_path, content=CONTENT, staging_dir='staging'):
+    output_file_path = str(tmp_path / 'out' / 'RAINCELL.DAT')
+    os.makedirs(os.path.dirname(output_file_path), exist_ok=True)
+    staging_path = staging.get_staging_path(output_file_path, str(tmp_path / staging_dir) if staging_dir else None)
+    with open(staging_path, 'wb') as f:
+        f.write(content)
+    return staging_path, output_file_path
+
+
+def _tmp_files(tmp_path):
+    return [os.path.join(d, f) for d, _, files in os.walk(str(tmp_path)) for f in files if f.endswith('.tmp')]
+
+
+@pytest.mark.parametrize('staging_dir', ['staging', None])
+def test_publish_moves_the_staged_file_with_its_checksum(tmp_path, monkeypatch, staging_dir):
+    # copied in several blocks
+    monkeypatch.setattr(staging, 'BLOCK_SIZE', 4096)
+    staging_path, output_file_path = _stage(tmp_path, staging_dir=staging_dir)
+    entry = staging.publish(staging_path, output_file_path)
+    with open(output_file_path, 'rb') as f:
+        assert f.read() == CONTENT
+    assert entry['file'] == output_file_path
+    assert entry['size'] == len(CONTENT)
+    assert entry['sha256'] == hashlib.sha256(CONTENT).hexdigest()
+    assert 'compressed' not in entry
+    assert not os.path.exists(staging_path)
+    assert _tmp_files(tmp_path) == []
+
+
+def test_publish_replaces_the_previous_file(tmp_path):
+    staging_path, output_file_path = _stage(tmp_path)
+    with open(output_file_path, 'wb') as f:
+        f.write(b'previous run\n')
+    staging.publish(staging_path, output_file_path)
+    with open(output_file_path, 'rb') as f:
+        assert f.read() == CONTENT
+
+
+def test_publish_writes_the_compressed_copy(tmp_path, monkeypatch):
+    monkeypatch.setattr(staging, 'BLOCK_SIZE', 4096)
+    staging_path, output_file_path = _stage(tmp_path)
+    entry = staging.publish(staging_path, output_file_path, compression='gzip')
+    compressed_path = output_file_path + '.gz'
+    assert entry['compressed'] == {'file': compressed_path, 'size': os.path.getsize(compressed_path)}
+    with gzip.open(compressed_path, 'rb') as f:
+        assert f.read() == CONTENT
+    assert entry['sha256'] == hashlib.sha256(CONTENT).hexdigest()
+    assert _tmp_files(tmp_path) == []
+
+
+def test_a_failed_publish_keeps_the_previous_files(tmp_path, monkeypatch):
+    staging_path, output_file_path = _stage(tmp_path)
+    with open(output_file_path, 'wb') as f:
+        f.write(b'previous run\n')
+
+    def _failing_open(path, compression):
+        raise IOError('disk full')
+
+    monkeypatch.setattr(staging, '_open_compressed', _failing_open)
+    with pytest.raises(IOError, match='disk full'):
+        staging.publish(staging_path, output_file_path, compression='gzip')
+    with open(output_file_path, 'rb') as f:
+        assert f.read() == b'previous run\n'
+    assert not os.path.exists(output_file_path + '.gz')
+    assert not os.path.exists(staging_path)
+    assert _tmp_files(tmp_path) == []
+
+
+def test_atomic_write_keeps_the_previous_file_on_failure(tmp_path):
+    path = str(tmp_path / 'state.json')
+    staging.write_json(path, {'run': 1})
+    with pytest.raises(ValueError):
+        with staging.atomic_write(path) as f:
+            f.write('{"run": ')
+            raise ValueError('interrupted')
+    with open(path) as f:
+        assert json.load(f) == {'run': 1}
+    assert _tmp_files(tmp_path) == []
+
+
+def test_write_manifest_lists_the_files_relative_to_the_output_dir(tmp_path):
+    staging_path, output_file_path = _stage(tmp_path)
+    entry = staging.publish(staging_path, output_file_path, compression='gzip')
+    path = staging.write_manifest(str(tmp_path / 'out'), [dict(entry, model='250m')], tag='wrf0')
+    with open(path) as f:
+        manifest = json.load(f)
+    assert manifest['tag'] == 'wrf0'
+    assert [(e['file'], e['compressed']['file'], e['model']) for e in manifest['files']] == \
+        [('RAINCELL.DAT', 'RAINCELL.DAT.gz', '250m')]